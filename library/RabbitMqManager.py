@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from robot.api import logger
+from robot.libraries.BuiltIn import BuiltIn
 from robot.utils import ConnectionCache
 import httplib
 import base64 
@@ -8,6 +9,22 @@ import json
 import socket
 import urlparse
 import urllib
+import re
+import math
+import time
+import csv
+import os
+import threading
+import zlib
+import struct
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+try:
+    import pika
+except ImportError:
+    # pika нужен только для Benchmark Amqp Throughput
+    pika=None
 
 
 class RabbitMqManager(object):
@@ -20,6 +37,7 @@ class RabbitMqManager(object):
     
     == Зависимости ==
     | robot framework | http://robotframework.org |
+    | pika | https://pypi.python.org/pypi/pika | только для [#Benchmark Amqp Throughput|Benchmark Amqp Throughput] |
     
     == Example ==
     | *Settings* | *Value* |
@@ -36,10 +54,27 @@ class RabbitMqManager(object):
 
     ROBOT_LIBRARY_SCOPE='GLOBAL'
 
+    # сегменты uri, которые сохраняются в шаблоне пути при сборе статистики запросов
+    _PATH_TEMPLATE_KEYWORDS=('get', 'publish', 'contents', 'bindings', 'permissions', 'channels',
+                             'connections', 'consumers', 'source', 'destination', 'e', 'q')
+    # размер блока при чтении тела ответа
+    _READ_CHUNK_SIZE=65536
+    # служебные символы json вне строк и внутри строк при поиске границ элементов массива
+    _JSON_SPECIAL_RE=re.compile(r'[\[\]{},"]')
+    _JSON_STRING_RE=re.compile(r'["\\]')
+    # количество неподтвержденных сообщений на одного потребителя в нагрузочном тесте
+    _BENCHMARK_PREFETCH_COUNT=100
+
     def __init__(self):
         self._connection=None
         self.headers=None
         self._cache=ConnectionCache()
+        # заголовки и псевдонимы соединений по их индексу в кеше
+        self._headers={}
+        self._aliases={}
+        # статистика выполненных запросов
+        self._request_samples=[]
+        self._request_samples_lock=threading.Lock()
 
     def connect_to_rabbitmq (self, host, port, username = 'guest', password = 'guest', timeout = 15, alias = None):
         """
@@ -70,7 +105,10 @@ class RabbitMqManager(object):
         try:
             self._connection=httplib.HTTPConnection (host, port, timeout)
             self._connection.connect()
-            return self._cache.register(self._connection, alias)
+            index=self._cache.register(self._connection, alias)
+            self._headers[index]=self.headers
+            self._aliases[index]=alias
+            return index
         except socket.error, e:
             raise Exception ("Could not connect to RabbitMq", str(e))
 
@@ -98,6 +136,7 @@ class RabbitMqManager(object):
 
         old_index=self._cache.current_index
         self._connection=self._cache.switch(index_or_alias)
+        self.headers=self._headers[self._cache.current_index]
         return old_index
 
     def disconnect_from_rabbitmq(self):
@@ -128,8 +167,10 @@ class RabbitMqManager(object):
         """
 
         self._connection=self._cache.close_all()
+        self._headers={}
+        self._aliases={}
 
-    def _http_request (self, method, path, body):
+    def _http_request (self, method, path, body, connection=None, headers=None, stream=False):
         """
         Выполнение запросов к RabbitMq
         
@@ -137,36 +178,376 @@ class RabbitMqManager(object):
         _method_ - метод запроса;\n
         _path_ - uri запроса;\n
         _body_ - тело POST-запроса;\n
+        _connection_ - соединение, через которое выполняется запрос (по умолчанию текущее);\n
+        _headers_ - заголовки запроса (по умолчанию заголовки текущего соединения);\n
+        _stream_ - если True, то возвращается генератор распакованных блоков тела ответа;\n
         """
 
+        if connection is None:
+            connection=self._connection
+        headers=dict(self.headers if headers is None else headers)
+        headers["Accept-Encoding"]="gzip"
         if body!="":
-            self.headers["Content-Type"]="application/json"
+            headers["Content-Type"]="application/json"
 
-        logger.debug ('Prepared request with metod '+method+' to '+'http://'+self._connection.host+':'+str(self._connection.port)+path+' and body\n'+body)
+        logger.debug ('Prepared request with metod '+method+' to '+'http://'+connection.host+':'+str(connection.port)+path+' and body\n'+body)
 
+        start=time.time()
+        status=None
+        size=0
+        streamed=False
         try:
-            self._connection.request(method, path, body, self.headers)
-        except socket.error, e:
-            raise Exception("Could not send request: {0}".format(e))
+            try:
+                connection.request(method, path, body, headers)
+            except socket.error, e:
+                raise Exception("Could not send request: {0}".format(e))
 
-        resp=self._connection.getresponse()
+            resp=connection.getresponse()
+            status=resp.status
+
+            if resp.status==400:
+                raise Exception (json.loads(self._read_body(resp))['reason'])
+            if resp.status==401:
+                raise Exception("Access refused: {0}".format('http://'+connection.host+':'+str(connection.port)+path))
+            if resp.status==404:
+                raise Exception("Not found: {0}".format('http://'+connection.host+':'+str(connection.port)+path))
+            if resp.status==301:
+                url=urlparse.urlparse(resp.getheader('location'))
+                [host, port]=url.netloc.split(':')
+                self.options.hostname=host
+                self.options.port=int(port)
+                return self.http(method, url.path+'?'+url.query, body)
+            if resp.status<200 or resp.status>400:
+                raise Exception("Received %d %s for request %s\n%s"
+                                %(resp.status, resp.reason, 'http://'+connection.host+':'+str(connection.port)+path, self._read_body(resp)))
+            if stream:
+                streamed=True
+                return self._iter_response(resp, method, path, start)
+            data=[]
+            for chunk, chunk_size in self._read_response(resp):
+                data.append(chunk)
+                size+=chunk_size
+            return ''.join(data)
+        finally:
+            if not streamed:
+                self._record_request(method, path, status, size, time.time()-start)
+
+    def _read_response (self, resp):
+        """
+        Чтение тела ответа блоками с распаковкой gzip.
+        
+        *Returns:*\n
+        Генератор пар (распакованный блок, размер полученного блока).
+        """
+
+        decompressor=None
+        if resp.getheader('content-encoding', '').lower()=='gzip':
+            decompressor=zlib.decompressobj(16+zlib.MAX_WBITS)
+        while True:
+            chunk=resp.read(self._READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            if decompressor is None:
+                yield chunk, len(chunk)
+            else:
+                yield decompressor.decompress(chunk), len(chunk)
+        if decompressor is not None:
+            yield decompressor.flush(), 0
+
+    def _read_body (self, resp):
+        """
+        Чтение всего тела ответа с распаковкой gzip.
+        """
+
+        return ''.join(chunk for chunk, _size in self._read_response(resp))
+
+    def _iter_response (self, resp, method, path, start):
+        """
+        Генератор распакованных блоков тела ответа; статистика запроса сохраняется после чтения всего ответа.
+        """
+
+        size=0
+        try:
+            for chunk, chunk_size in self._read_response(resp):
+                size+=chunk_size
+                yield chunk
+        finally:
+            self._record_request(method, path, resp.status, size, time.time()-start)
+
+    def _iter_json_list (self, chunks):
+        """
+        Последовательное декодирование json-массива, получаемого блоками.
+        
+        Границы элементов находятся однопроходным сканированием блоков с учетом строк и вложенности.
+        Элемент декодируется один раз и только после получения следующего за ним ',' или ']',
+        поэтому число или литерал, разрезанный границей блока, не декодируется раньше времени.
+        Весь список в памяти не строится.
+        """
+
+        opened=False
+        closed=False
+        started=False
+        # полученные части текущего элемента
+        item=[]
+        start=0
+        depth=0
+        in_string=False
+        escape=False
+        for data in chunks:
+            i=0
+            n=len(data)
+            while i<n and not closed:
+                if not opened:
+                    while i<n and data[i] in ' \t\r\n':
+                        i+=1
+                    if i==n:
+                        break
+                    if data[i]!='[':
+                        raise Exception('Could not decode json list: %s'%data[i:i+100])
+                    opened=True
+                    i+=1
+                    continue
+                if not started:
+                    while i<n and data[i] in ' \t\r\n,':
+                        i+=1
+                    if i==n:
+                        break
+                    if data[i]==']':
+                        closed=True
+                        break
+                    started=True
+                    start=i
+                if in_string:
+                    if escape:
+                        escape=False
+                        i+=1
+                        continue
+                    match=self._JSON_STRING_RE.search(data, i)
+                    if match is None:
+                        i=n
+                        break
+                    i=match.end()
+                    if match.group()=='\\':
+                        escape=True
+                    else:
+                        in_string=False
+                    continue
+                match=self._JSON_SPECIAL_RE.search(data, i)
+                if match is None:
+                    i=n
+                    break
+                char=match.group()
+                i=match.start()
+                if char=='"':
+                    in_string=True
+                    i+=1
+                elif char in '[{':
+                    depth+=1
+                    i+=1
+                elif char=='}' or (char==']' and depth>0):
+                    depth-=1
+                    i+=1
+                elif depth>0:
+                    i+=1
+                else:
+                    # ',' или ']' на верхнем уровне - элемент получен полностью
+                    item.append(data[start:i])
+                    yield json.loads(''.join(item))
+                    item=[]
+                    started=False
+            if started:
+                item.append(data[start:])
+                start=0
+        if opened and not closed:
+            raise Exception('Could not decode json list: %s'%''.join(item)[:100])
+
+    def _get_names (self, path):
+        """
+        Список имен объектов, возвращаемых запросом списка.
+        
+        Сервер возвращает только поле name (параметр columns), ответ декодируется потоково.
+        """
+
+        chunks=self._http_request('GET', '/api%s?columns=name'%path, '', stream=True)
+        return [item['name'] for item in self._iter_json_list(chunks)]
+
+    def _record_request (self, method, path, status, size, latency):
+        """
+        Сохранение статистики выполненного запроса.
+        """
+
+        sample=(time.time(), method, self._path_template(path), status, size, latency)
+        with self._request_samples_lock:
+            self._request_samples.append(sample)
+
+    def _path_template (self, path):
+        """
+        Шаблон пути запроса: имена vhost, очередей и т.п. заменяются на *.
+        
+        Например, /api/queues/%2F/my_queue/get => /api/queues/*/*/get
+        """
+
+        segments=path.split('?')[0].strip('/').split('/')
+        template=segments[:2]
+        for segment in segments[2:]:
+            template.append(segment if segment in self._PATH_TEMPLATE_KEYWORDS else '*')
+        return '/'+'/'.join(template)
+
+    def _clone_connection (self, connection=None):
+        """
+        Создание нового соединения с тем же сервером RabbitMq.
+        
+        Используется для параллельных запросов, так как httplib.HTTPConnection
+        не может обслуживать несколько запросов одновременно.
+        """
+
+        if connection is None:
+            connection=self._connection
+        return httplib.HTTPConnection (connection.host, connection.port, connection.timeout)
+
+    def get_from_all_rabbitmq_connections(self, path='/overview', timeout=5, aliases=None):
+        """
+        Run the same GET request of management API on all registered connections in parallel.
+        
+        Every server is queried through its own new HTTP connection, so total time
+        is equal to the time of the slowest server, not to the sum of all of them.
+        
+        *Args:*\n
+        _path_ - path of management API without "/api" prefix, e.g. /overview, /nodes, /healthchecks/node;\n
+        _timeout_ - timeout of the request to one server, in seconds;\n
+        _aliases_ - list of connection aliases or indexes; by default all registered connections are queried;\n
+        
+        *Returns:*\n
+        Dictionary with alias (index, if the connection has no alias) as a key and a dictionary as a value:
+        | status  | PASS or FAIL |
+        | result  | decoded json response (None if the request failed) |
+        | error   | error message (None if the request succeeded) |
+        | elapsed | request time in seconds |
+        
+        *Example:*\n
+        | Connect To Rabbitmq | my_host_name_1 | 15672 | guest | guest | alias=rmq1 |
+        | Connect To Rabbitmq | my_host_name_2 | 15672 | guest | guest | alias=rmq2 |
+        | ${nodes}=  |  Get From All Rabbitmq Connections  |  /nodes  |  timeout=3 |
+        | Should Be Equal  |  ${nodes['rmq1']['status']}  |  PASS |
+        """
+
+        timeout=float(timeout)
+        if aliases is None:
+            indexes=sorted(self._headers.keys())
+        else:
+            indexes=[self._resolve_index(alias) for alias in aliases]
+        if not indexes:
+            return {}
+        registered=list(self._cache)
+
+        def query(index):
+            connection=httplib.HTTPConnection (registered[index-1].host, registered[index-1].port, timeout)
+            start=time.time()
+            try:
+                result=json.loads(self._http_request('GET', '/api%s'%path, '', connection, self._headers[index]))
+                return {'status': 'PASS', 'result': result, 'error': None, 'elapsed': time.time()-start}
+            except Exception, e:
+                return {'status': 'FAIL', 'result': None, 'error': str(e), 'elapsed': time.time()-start}
+            finally:
+                connection.close()
+
+        pool=ThreadPool(len(indexes))
+        try:
+            async_results=[(index, pool.apply_async(query, (index,))) for index in indexes]
+            deadline=time.time()+timeout
+            results={}
+            for index, async_result in async_results:
+                name=self._aliases[index] if self._aliases[index] is not None else str(index)
+                try:
+                    results[name]=async_result.get(max(deadline-time.time(), 0))
+                except multiprocessing.TimeoutError:
+                    results[name]={'status': 'FAIL', 'result': None,
+                                   'error': 'Timeout %s seconds exceeded'%timeout, 'elapsed': timeout}
+        finally:
+            pool.terminate()
+        return results
+
+    def _resolve_index(self, index_or_alias):
+        """
+        Получение индекса соединения по его псевдониму или индексу.
+        """
+
+        for index, alias in self._aliases.items():
+            if alias is not None and alias==index_or_alias:
+                return index
+        return int(index_or_alias)
+
+    def get_rabbitmq_request_metrics(self, csv_file=None):
+        """
+        Statistics of requests to management API made by the library.
+        
+        Requests are grouped by method and path template (names of vhosts, queues, exchanges
+        are replaced with *). The summary is written to the log.
+        
+        *Args:*\n
+        _csv_file_ - name of file to write all raw samples to; relative path is resolved against ${OUTPUT_DIR};\n
+        
+        *Returns:*\n
+        Dictionary with "<method> <path template>" as a key and a dictionary as a value:
+        | count | number of requests |
+        | bytes | total size of response bodies |
+        | p50   | median latency, seconds |
+        | p95   | 95th percentile of latency, seconds |
+        | max   | maximum latency, seconds |
+        
+        *Example:*\n
+        | ${metrics}=  |  Get Rabbitmq Request Metrics  |  rabbitmq_requests.csv |
+        =>\n
+        | GET /api/queues | count=120 | bytes=15728640 | p50=0.412 | p95=0.975 | max=1.203 |
+        """
+
+        with self._request_samples_lock:
+            samples=list(self._request_samples)
+        groups={}
+        for _timestamp, method, template, _status, size, latency in samples:
+            groups.setdefault(method+' '+template, []).append((latency, size))
+        summary={}
+        for endpoint, values in groups.items():
+            latencies=sorted(latency for latency, _size in values)
+            summary[endpoint]={'count': len(latencies),
+                               'bytes': sum(size for _latency, size in values),
+                               'p50': self._percentile(latencies, 50),
+                               'p95': self._percentile(latencies, 95),
+                               'max': latencies[-1]}
+        lines=['%s | count=%d | bytes=%d | p50=%.3f | p95=%.3f | max=%.3f'
+               %(endpoint, item['count'], item['bytes'], item['p50'], item['p95'], item['max'])
+               for endpoint, item in sorted(summary.items(), key=lambda pair: -pair[1]['max'])]
+        logger.info('RabbitMq management API requests:\n'+'\n'.join(lines))
+
+        if csv_file is not None:
+            if not os.path.isabs(csv_file):
+                csv_file=os.path.join(BuiltIn().get_variable_value('${OUTPUT_DIR}'), csv_file)
+            with open(csv_file, 'wb') as csv_out:
+                writer=csv.writer(csv_out)
+                writer.writerow(['timestamp', 'method', 'path', 'status', 'bytes', 'latency'])
+                for sample in samples:
+                    writer.writerow(sample)
+            logger.info('Raw samples are written to %s'%csv_file)
+        return summary
+
+    def reset_rabbitmq_request_metrics(self):
+        """
+        Clear statistics of requests to management API.
+        
+        *Example:*\n
+        | Reset Rabbitmq Request Metrics |
+        """
 
-        if resp.status==400:
-            raise Exception (json.loads(resp.read())['reason'])
-        if resp.status==401:
-            raise Exception("Access refused: {0}".format('http://'+self._connection.host+':'+str(self._connection.port)+path))
-        if resp.status==404:
-            raise Exception("Not found: {0}".format('http://'+self._connection.host+':'+str(self._connection.port)+path))
-        if resp.status==301:
-            url=urlparse.urlparse(resp.getheader('location'))
-            [host, port]=url.netloc.split(':')
-            self.options.hostname=host
-            self.options.port=int(port)
-            return self.http(method, url.path+'?'+url.query, body)
-        if resp.status<200 or resp.status>400:
-            raise Exception("Received %d %s for request %s\n%s"
-                            %(resp.status, resp.reason, 'http://'+self._connection.host+':'+str(self._connection.port)+path, resp.read()))
-        return resp.read()
+        with self._request_samples_lock:
+            self._request_samples=[]
+
+    def _percentile (self, values, percent):
+        """
+        Перцентиль отсортированного списка (метод ближайшего ранга).
+        """
+
+        rank=int(math.ceil(percent/100.0*len(values)))
+        return values[min(max(rank, 1), len(values))-1]
 
     def _get (self, path):
         return self._http_request('GET', '/api%s'%path, '')
@@ -258,11 +639,7 @@ class RabbitMqManager(object):
         Список имен всех открытых соединений.
         """
         
-        names=[]
-        data=self.connections ()
-        for item in data :
-            names.append(item['name'])
-        return names
+        return self._get_names('/connections')
     
     def channels (self):
         """
@@ -302,11 +679,7 @@ class RabbitMqManager(object):
         | amq.direct
         """
         
-        names=[]
-        data=self.exchanges ()
-        for item in data :
-            names.append(item['name'])
-        return names
+        return self._get_names('/exchanges')
 
     def queues (self):
         """
@@ -339,11 +712,7 @@ class RabbitMqManager(object):
         | List has one item:
         | federation: ex2 -> rabbit@server.net.ru
         """
-        names=[]
-        data=self.get_queues_on_vhost (vhost)
-        for item in data :
-            names.append(item['name'])
-        return names
+        return self._get_names('/queues/'+self._quote_vhost(vhost))
     
     def queue_exists(self, queue, vhost='%2F'):
         """
@@ -366,6 +735,94 @@ class RabbitMqManager(object):
 
         return self._delete('/queues/'+self._quote_vhost(vhost)+'/'+urllib.quote(name))
 
+    def delete_queues_by_pattern(self, pattern, vhost='%2F', workers=10):
+        """
+        Delete all queues of a virtual host whose names match a regular expression.
+        
+        Queues are deleted concurrently: names are split between _workers_ threads,
+        each of them uses its own HTTP connection to the current RabbitMq server.
+        
+        *Args:*\n
+        _pattern_ - regular expression for queue names (re.match);\n
+        _vhost_ - virtual host name (quoted with urllib.quote);\n
+        _workers_ - maximum number of concurrent connections;\n
+        
+        *Returns:*\n
+        List of deleted queue names.
+        
+        *Example:*\n
+        | ${deleted}=  |  Delete Queues By Pattern  |  test\\..*  |
+        """
+
+        regexp=re.compile(pattern)
+        names=[name for name in self.get_names_of_queues_on_vhost(vhost) if regexp.match(name)]
+        if not names:
+            return []
+        workers=min(int(workers), len(names))
+        path='/api/queues/'+self._quote_vhost(vhost)+'/'
+        logger.debug('Deleting %d queues using %d connections'%(len(names), workers))
+
+        def delete_chunk(chunk):
+            connection=self._clone_connection()
+            try:
+                for name in chunk:
+                    self._http_request('DELETE', path+urllib.quote(name), '', connection)
+            finally:
+                connection.close()
+
+        pool=ThreadPool(workers)
+        try:
+            pool.map(delete_chunk, [names[i::workers] for i in range(workers)])
+        finally:
+            pool.close()
+            pool.join()
+        return names
+
+    def get_definitions(self, vhost=None):
+        """
+        Export server definitions (users, vhosts, permissions, exchanges, queues, bindings, policies).
+        
+        *Args:*\n
+        _vhost_ - virtual host name; if set, only definitions of this virtual host are exported;\n
+        
+        *Returns:*\n
+        Dictionary with definitions.
+        
+        *Example:*\n
+        | ${definitions}=  |  Get Definitions  |  vhost=/ |
+        | Log Dictionary  |  ${definitions} |
+        """
+
+        return json.loads(self._get(self._definitions_path(vhost)))
+
+    def load_definitions(self, definitions, vhost=None):
+        """
+        Import server definitions in one request.
+        
+        All exchanges, queues and bindings of the document are declared by the server at once.
+        
+        *Args:*\n
+        _definitions_ - dictionary with definitions or json string;\n
+        _vhost_ - virtual host name; if set, definitions are imported into this virtual host;\n
+        
+        *Example:*\n
+        | ${definitions}=  |  Get Definitions  |  vhost=/ |
+        | Load Definitions  |  ${definitions}  |  vhost=test |
+        """
+
+        if not isinstance(definitions, basestring):
+            definitions=json.dumps(definitions)
+        return self._post(self._definitions_path(vhost), body=definitions)
+
+    def _definitions_path(self, vhost):
+        """
+        Path to definitions of the server or of a virtual host.
+        """
+
+        if vhost is None:
+            return '/definitions'
+        return '/definitions/'+self._quote_vhost(vhost)
+
     def vhosts (self):
         """
         Список виртуальных хостов.
@@ -437,3 +894,174 @@ class RabbitMqManager(object):
         """
         return self._delete('/queues/' + self._quote_vhost(vhost) + '/' + urllib.quote(name) + '/contents')
 
+    def benchmark_amqp_throughput(self, host, queue, count=10000, size=1024, port=5672, username='guest',
+                                  password='guest', vhost='/', producers=1, consumers=1, confirm=True, timeout=300):
+        """
+        Measure broker throughput over AMQP.
+        
+        _count_ messages of _size_ bytes are published to _queue_ (through the default exchange)
+        by _producers_ threads and consumed from it by _consumers_ threads at the same time.
+        Every thread uses its own AMQP connection. The queue must exist and should be empty.
+        Time measurement starts when all connections are open.
+        
+        Publish time is written into the first 8 bytes of every message, so end-to-end latency
+        is measured by consumers. If _confirm_ is True, publisher confirms are enabled and
+        confirm latency is measured for every message.
+        
+        *Args:*\n
+        _host_ - AMQP server name;\n
+        _queue_ - queue name;\n
+        _count_ - total number of messages;\n
+        _size_ - message size in bytes (at least 8);\n
+        _port_ - AMQP port;\n
+        _username_ - user name;\n
+        _password_ - user password;\n
+        _vhost_ - virtual host name (not quoted);\n
+        _producers_ - number of publishing threads;\n
+        _consumers_ - number of consuming threads;\n
+        _confirm_ - use publisher confirms;\n
+        _timeout_ - maximum duration of the benchmark in seconds;\n
+        
+        *Returns:*\n
+        Dictionary with results; all times are in seconds:
+        | published | number of published messages |
+        | consumed | number of consumed messages |
+        | elapsed | time from the start (all connections are open) until the last message is consumed |
+        | publish_rate | published messages per second |
+        | consume_rate | consumed messages per second |
+        | latency_p50, latency_p95, latency_p99, latency_max | end-to-end latency |
+        | confirm_p50, confirm_p95, confirm_p99, confirm_max | confirm latency (only if _confirm_ is True) |
+        
+        *Raises:*\n
+        Exception if pika is not installed or not all messages are consumed in _timeout_ seconds.
+        
+        *Example:*\n
+        | Create Queues By Name  |  benchmark |
+        | ${result}=  |  Benchmark Amqp Throughput  |  my_host_name  |  benchmark  |  count=100000  |  size=4096  |  producers=4  |  consumers=4 |
+        | Log Dictionary  |  ${result} |
+        """
+
+        if pika is None:
+            raise Exception('pika is required for AMQP benchmark: https://pypi.python.org/pypi/pika')
+        count=int(count)
+        size=max(int(size), 8)
+        producers=int(producers)
+        consumers=int(consumers)
+        timeout=float(timeout)
+        confirm=confirm not in (False, 'False', 'false', 'FALSE')
+        parameters=pika.ConnectionParameters(host=host, port=int(port), virtual_host=vhost,
+                                             credentials=pika.PlainCredentials(username, password))
+        padding='x'*(size-8)
+        lock=threading.Lock()
+        state={'published': 0, 'consumed': 0, 'latencies': [], 'confirms': [], 'errors': [],
+               'ready': 0, 'start': 0, 'publish_end': 0, 'consume_end': 0}
+        done=threading.Event()
+        started=threading.Event()
+        deadline=time.time()+timeout
+
+        def wait_start():
+            # все потоки начинают работу одновременно, после открытия всех соединений
+            with lock:
+                state['ready']+=1
+                if state['ready']>=producers+consumers:
+                    state['start']=time.time()
+                    started.set()
+            started.wait(max(deadline-time.time(), 0))
+
+        def produce(messages):
+            try:
+                connection=self._amqp_connect(parameters)
+                try:
+                    channel=connection.channel()
+                    if confirm:
+                        channel.confirm_delivery()
+                    confirms=[]
+                    published=0
+                    wait_start()
+                    for _ in xrange(messages):
+                        if time.time()>deadline:
+                            break
+                        sent=time.time()
+                        channel.basic_publish(exchange='', routing_key=queue, body=struct.pack('!d', sent)+padding)
+                        published+=1
+                        if confirm:
+                            confirms.append(time.time()-sent)
+                    with lock:
+                        state['published']+=published
+                        state['confirms'].extend(confirms)
+                        state['publish_end']=max(state['publish_end'], time.time())
+                finally:
+                    connection.close()
+            except Exception, e:
+                with lock:
+                    state['errors'].append('producer: %s'%e)
+                done.set()
+                started.set()
+
+        def consume():
+            try:
+                connection=self._amqp_connect(parameters)
+                try:
+                    channel=connection.channel()
+                    channel.basic_qos(prefetch_count=self._BENCHMARK_PREFETCH_COUNT)
+                    latencies=[]
+                    wait_start()
+                    for method, _properties, body in channel.consume(queue, inactivity_timeout=1):
+                        if method is not None:
+                            latencies.append(time.time()-struct.unpack('!d', body[:8])[0])
+                            channel.basic_ack(delivery_tag=method.delivery_tag)
+                            with lock:
+                                state['consumed']+=1
+                                if state['consumed']>=count and not done.is_set():
+                                    state['consume_end']=time.time()
+                                    done.set()
+                        if done.is_set() or time.time()>deadline:
+                            break
+                    channel.cancel()
+                    with lock:
+                        state['latencies'].extend(latencies)
+                finally:
+                    connection.close()
+            except Exception, e:
+                with lock:
+                    state['errors'].append('consumer: %s'%e)
+                done.set()
+                started.set()
+
+        threads=[threading.Thread(target=consume) for _ in range(consumers)]
+        threads+=[threading.Thread(target=produce, args=(count//producers+(1 if i<count%producers else 0),))
+                  for i in range(producers)]
+        for thread in threads:
+            thread.daemon=True
+            thread.start()
+        for thread in threads:
+            thread.join(max(deadline-time.time(), 0)+5)
+
+        if state['errors']:
+            raise Exception('AMQP benchmark failed: %s'%'; '.join(state['errors']))
+        if state['consumed']<count:
+            raise Exception('Only %d of %d messages are consumed in %s seconds'%(state['consumed'], count, timeout))
+        elapsed=max(state['consume_end']-state['start'], 1e-6)
+        result={'published': state['published'],
+                'consumed': state['consumed'],
+                'elapsed': elapsed,
+                'publish_rate': state['published']/max(state['publish_end']-state['start'], 1e-6),
+                'consume_rate': state['consumed']/elapsed}
+        for name, values in (('latency', state['latencies']), ('confirm', state['confirms'])):
+            if values:
+                values.sort()
+                for percent in (50, 95, 99):
+                    result['%s_p%d'%(name, percent)]=self._percentile(values, percent)
+                result[name+'_max']=values[-1]
+        logger.info('AMQP benchmark: %d messages of %d bytes, %.1f msg/s published, %.1f msg/s consumed'
+                    %(count, size, result['publish_rate'], result['consume_rate']))
+        return result
+
+    def _amqp_connect(self, parameters):
+        """
+        Создание AMQP-соединения для нагрузочного теста.
+        
+        Может быть переопределен для подмены брокера в тестах.
+        """
+
+        return pika.BlockingConnection(parameters)
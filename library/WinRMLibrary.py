@@ -2,7 +2,68 @@
 
 from robot.api import logger
 from robot.utils import ConnectionCache
+from AdvancedLogging import AdvancedLogging
+from base64 import b64encode, b64decode
+from collections import deque
+import hashlib
+import os
+import re
+import threading
+import time
+import zlib
 import winrm
+from winrm.exceptions import WinRMOperationTimeoutError
+
+# power shell script writing a file from stdin: one line per chunk, base64 of raw deflate (or of plain data)
+PUT_FILE_SCRIPT=u"""
+$ErrorActionPreference = 'Stop'
+$file = [System.IO.File]::Create('{path}')
+$sha = [System.Security.Cryptography.SHA256]::Create()
+try {{
+    while (($line = [Console]::In.ReadLine()) -ne $null) {{
+        if ($line -eq '') {{ continue }}
+        $data = [Convert]::FromBase64String($line)
+        if (${compress}) {{
+            $source = New-Object System.IO.Compression.DeflateStream((New-Object System.IO.MemoryStream(,$data)), [System.IO.Compression.CompressionMode]::Decompress)
+            $target = New-Object System.IO.MemoryStream
+            $source.CopyTo($target)
+            $data = $target.ToArray()
+        }}
+        $file.Write($data, 0, $data.Length)
+        $sha.TransformBlock($data, 0, $data.Length, $null, 0) | Out-Null
+    }}
+    $sha.TransformFinalBlock((New-Object byte[] 0), 0, 0) | Out-Null
+    [Console]::Out.WriteLine([BitConverter]::ToString($sha.Hash).Replace('-', '').ToLower())
+}} finally {{
+    $file.Close()
+}}
+"""
+
+# power shell script writing a file to stdout: one line per chunk, then the line SHA256:<hash>
+GET_FILE_SCRIPT=u"""
+$ErrorActionPreference = 'Stop'
+$file = [System.IO.File]::OpenRead('{path}')
+$sha = [System.Security.Cryptography.SHA256]::Create()
+$buffer = New-Object byte[] {chunk_size}
+try {{
+    while (($read = $file.Read($buffer, 0, $buffer.Length)) -gt 0) {{
+        $sha.TransformBlock($buffer, 0, $read, $null, 0) | Out-Null
+        $target = New-Object System.IO.MemoryStream
+        if (${compress}) {{
+            $deflate = New-Object System.IO.Compression.DeflateStream($target, [System.IO.Compression.CompressionMode]::Compress)
+            $deflate.Write($buffer, 0, $read)
+            $deflate.Close()
+        }} else {{
+            $target.Write($buffer, 0, $read)
+        }}
+        [Console]::Out.WriteLine([Convert]::ToBase64String($target.ToArray()))
+    }}
+    $sha.TransformFinalBlock($buffer, 0, 0) | Out-Null
+    [Console]::Out.WriteLine('SHA256:' + [BitConverter]::ToString($sha.Hash).Replace('-', '').ToLower())
+}} finally {{
+    $file.Close()
+}}
+"""
 
 class WinRMLibrary(object):
     """
@@ -17,8 +78,9 @@ class WinRMLibrary(object):
      | winrm set winrm/config/service @{AllowUnencrypted="true"}
 
     == Dependence ==
-    | pywinrm | https://pypi.python.org/pypi/pywinrm | 
+    | pywinrm | https://pypi.python.org/pypi/pywinrm | version >= 0.4 for [#Put File|Put File] |
     | robot framework | http://robotframework.org |
+    | AdvancedLogging | for output files of [#Run cmd to file|Run cmd to file] and [#Run ps to file|Run ps to file] |
     """
 
     ROBOT_LIBRARY_SCOPE='GLOBAL'
@@ -26,6 +88,11 @@ class WinRMLibrary(object):
     def __init__(self):
         self._session=None
         self._cache=ConnectionCache('No sessions created')
+        # opened shells: alias -> shell id
+        self._shells={}
+        # sessions by alias, used from several threads without switching of the cache
+        self._sessions={}
+        self.adv_log=AdvancedLogging()
 
     def create_session (self, alias, hostname, login, password):
         """
@@ -48,6 +115,7 @@ class WinRMLibrary(object):
 
         logger.debug ('Connecting using : hostname=%s, login=%s, password=%s '%(hostname, login, password))
         self._session=winrm.Session(hostname, (login, password))
+        self._sessions[alias]=self._session
         return self._cache.register(self._session, alias)
 
     def run_cmd (self, alias, command, params=None):
@@ -116,7 +184,608 @@ class WinRMLibrary(object):
         result=self._session.run_ps (script)
         return result
 
+    def open_shell (self, alias):
+        """
+        Open a shell on remote mashine, which lives until [#Close Shell|Close Shell].
+        
+        Commands run by [#Run cmd in shell|Run cmd in shell] and [#Run ps in shell|Run ps in shell]
+        use this shell, so the shell is not opened and closed for every command.
+        
+        *Args:*\n
+        _alias_ - robot framework alias to identify the session
+        
+        *Example:*\n
+        | Open Shell  |  server |
+        | ${result}=  |  Run cmd in shell  |  server  |  hostname |
+        | Close Shell  |  server |
+        """
+
+        if alias in self._shells:
+            raise Exception('Shell is already opened on server with alias "%s"'%alias)
+        self._session=self._cache.switch(alias)
+        self._shells[alias]=self._session.protocol.open_shell()
+        logger.debug ('Opened shell %s on server with alias "%s"'%(self._shells[alias], alias))
+
+    def run_cmd_in_shell (self, alias, command, params=None):
+        """
+        Execute command in the shell opened by [#Open Shell|Open Shell].
+        
+        *Args:*\n
+        _alias_ - robot framework alias to identify the session\n
+        _command_ -  windows command\n
+        _params_ - lists of command's parameters
+        
+        *Returns:*\n
+        Result object with methods: status_code, std_out, std_err.
+        
+        *Example:*\n
+        | Open Shell  |  server |
+        | ${params}=  | Create List  |  "/all" |
+        | ${result}=  |  Run cmd in shell  |  server  |  ipconfig  |  ${params} |
+        | Close Shell  |  server |
+        """
+
+        if params is None:
+            params=[]
+        logger.info ('Run command in shell on server with alias "%s": %s '%(alias, ' '.join([command]+list(params))))
+        self._session=self._cache.switch(alias)
+        return self._run_in_shell(self._session, self._shell(alias), command, params)
+
+    def run_ps_in_shell (self, alias, script):
+        """
+        Run power shell script in the shell opened by [#Open Shell|Open Shell].
+        
+        *Args:*\n
+         _alias_ - robot framework alias to identify the session\n
+         _script_ -  power shell script\n
+        
+        *Returns:*\n
+         Result object with methods: status_code, std_out, std_err.
+        
+        *Example:*\n
+        | Open Shell  |  server |
+        | ${result}=  |  Run ps in shell  |  server  |  get-process |
+        | Close Shell  |  server |
+        """
+
+        logger.info ('Run power shell script in shell on server with alias "%s": %s '%(alias, script))
+        self._session=self._cache.switch(alias)
+        result=self._run_in_shell(self._session, self._shell(alias), *self._ps_command(script))
+        return self._clean_ps_result(self._session, result)
+
+    def close_shell (self, alias):
+        """
+        Close the shell opened by [#Open Shell|Open Shell].
+        
+        *Args:*\n
+        _alias_ - robot framework alias to identify the session
+        
+        *Example:*\n
+        | Open Shell  |  server |
+        | Close Shell  |  server |
+        """
+
+        shell_id=self._shell(alias)
+        del self._shells[alias]
+        self._cache.switch(alias).protocol.close_shell(shell_id)
+
+    def run_cmd_batch (self, alias, commands):
+        """
+        Execute several commands one by one in one shell.
+        
+        The shell opened by [#Open Shell|Open Shell] is used if there is one,
+        otherwise a shell is opened for the batch and closed after it.
+        
+        *Args:*\n
+        _alias_ - robot framework alias to identify the session\n
+        _commands_ -  list of windows commands with parameters
+        
+        *Returns:*\n
+        List of result objects with methods: status_code, std_out, std_err.
+        
+        *Example:*\n
+        | ${commands}=  | Create List  |  mkdir C:\\temp\\test  |  echo test > C:\\temp\\test\\1.txt |
+        | ${results}=  |  Run cmd batch  |  server  |  ${commands} |
+        | Log  |  ${results[1].status_code} |
+        """
+
+        logger.info ('Run %d commands on server with alias "%s"'%(len(commands), alias))
+        self._session=self._cache.switch(alias)
+        if alias in self._shells:
+            return [self._run_in_shell(self._session, self._shells[alias], command) for command in commands]
+        shell_id=self._session.protocol.open_shell()
+        try:
+            return [self._run_in_shell(self._session, shell_id, command) for command in commands]
+        finally:
+            self._session.protocol.close_shell(shell_id)
+
+    def run_cmd_to_file (self, alias, command, params=None, filename=None, tail_lines=100, stop_pattern=None):
+        """
+        Execute command on remote mashine and write its output to a file while it is received.
+        
+        Output is written to a file in the test folder created by AdvancedLogging
+        (standard error to the file with suffix .stderr), only the last _tail_lines_ lines
+        are kept in memory. A shell opened by [#Open Shell|Open Shell] is used if there is one.
+        
+        *Args:*\n
+        _alias_ - robot framework alias to identify the session\n
+        _command_ -  windows command\n
+        _params_ - lists of command's parameters\n
+        _filename_ - name of output file; by default winrm_<alias>_<timestamp>.log\n
+        _tail_lines_ - number of last lines of output returned by the keyword\n
+        _stop_pattern_ - regular expression; the command is terminated as soon as an output line matches it
+        
+        *Returns:*\n
+        Result object with methods: status_code (None if the command is terminated), std_out and std_err
+        (last lines of output), log_file (path to output file), stopped (True if the command is terminated by _stop_pattern_).
+        
+        *Example:*\n
+        | ${params}=  | Create List  |  /s  |  C:\\ |
+        | ${result}=  |  Run cmd to file  |  server  |  dir  |  ${params}  |  tail_lines=10 |
+        | Log  |  ${result.log_file} |
+        | ${result}=  |  Run cmd to file  |  server  |  C:\\app\\start.bat  |  stop_pattern=Server started |
+        """
+
+        if params is None:
+            params=[]
+        logger.info ('Run command on server with alias "%s": %s '%(alias, ' '.join([command]+list(params))))
+        return self._run_to_file(alias, command, params, filename, tail_lines, stop_pattern)
+
+    def run_ps_to_file (self, alias, script, filename=None, tail_lines=100, stop_pattern=None):
+        """
+        Run power shell script on remote mashine and write its output to a file while it is received.
+        
+        *Args:*\n
+        _alias_ - robot framework alias to identify the session\n
+        _script_ -  power shell script\n
+        _filename_ - name of output file; by default winrm_<alias>_<timestamp>.log\n
+        _tail_lines_ - number of last lines of output returned by the keyword\n
+        _stop_pattern_ - regular expression; the script is terminated as soon as an output line matches it
+        
+        *Returns:*\n
+        Result object, see [#Run cmd to file|Run cmd to file].
+        
+        *Example:*\n
+        | ${result}=  |  Run ps to file  |  server  |  Get-Content C:\\app\\app.log -Wait  |  stop_pattern=ERROR |
+        """
+
+        logger.info ('Run power shell script on server with alias "%s": %s '%(alias, script))
+        command, params=self._ps_command(script)
+        result=self._run_to_file(alias, command, params, filename, tail_lines, stop_pattern)
+        return self._clean_ps_result(self._session, result)
+
+    def _run_to_file (self, alias, command, params, filename, tail_lines, stop_pattern):
+        """
+        Execute command with output written to a file, see Run cmd to file.
+        """
+
+        self._session=self._cache.switch(alias)
+        if filename is None:
+            filename='winrm_%s_%d.log'%(alias, time.time()*1000)
+        log_file=os.path.join(self.adv_log.create_advanced_logdir(), filename)
+        regexp=re.compile(stop_pattern) if stop_pattern is not None else None
+        tails={'out': deque(maxlen=int(tail_lines)), 'err': deque(maxlen=int(tail_lines))}
+        partial={'out': '', 'err': ''}
+        status_code=None
+        stopped=False
+
+        shell_id=self._shells.get(alias)
+        if shell_id is None:
+            shell_id=self._session.protocol.open_shell()
+        try:
+            with open(log_file, 'wb') as out_file, open(log_file+'.stderr', 'wb') as err_file:
+                output=self._iter_output(self._session, shell_id, command, params)
+                try:
+                    for std_out, std_err, status_code, _done in output:
+                        out_file.write(std_out)
+                        err_file.write(std_err)
+                        for stream, data in (('out', std_out), ('err', std_err)):
+                            lines=(partial[stream]+data).split('\n')
+                            partial[stream]=lines.pop()
+                            tails[stream].extend(lines)
+                            if stream=='out' and regexp is not None and any(regexp.search(line) for line in lines):
+                                stopped=True
+                        if stopped:
+                            status_code=None
+                            logger.info ('Output matches "%s", command is terminated'%stop_pattern)
+                            break
+                finally:
+                    output.close()
+        finally:
+            if alias not in self._shells:
+                self._session.protocol.close_shell(shell_id)
+
+        for stream in ('out', 'err'):
+            if partial[stream]:
+                tails[stream].append(partial[stream])
+        result=winrm.Response(('\n'.join(tails['out']), '\n'.join(tails['err']), status_code))
+        result.log_file=log_file
+        result.stopped=stopped
+        return result
+
+    def _iter_output (self, session, shell_id, command, params=()):
+        """
+        Execute command in the shell and yield its output as it is received.
+        
+        *Returns:*\n
+        Generator of tuples (std_out, std_err, status_code, done);
+        the command is cleaned up (terminated if it is still running) when the generator is closed.
+        """
+
+        protocol=session.protocol
+        command_id=protocol.run_command(shell_id, command, params)
+        try:
+            done=False
+            while not done:
+                try:
+                    std_out, std_err, status_code, done=protocol._raw_get_command_output(shell_id, command_id)
+                except WinRMOperationTimeoutError:
+                    # no output during operation timeout, the command is still running
+                    continue
+                yield std_out, std_err, status_code, done
+        finally:
+            protocol.cleanup_command(shell_id, command_id)
+
+    def put_file (self, alias, source, destination, chunk_size=131072, compress=True):
+        """
+        Copy a local file to remote mashine.
+        
+        The file is sent in chunks to the standard input of one power shell command,
+        each chunk is compressed with deflate if _compress_ is True. The checksum (SHA256)
+        of the written file is compared with the checksum of the local file.
+        A shell opened by [#Open Shell|Open Shell] is used if there is one.
+        
+        *Args:*\n
+        _alias_ - robot framework alias to identify the session\n
+        _source_ - path to local file\n
+        _destination_ - path to remote file\n
+        _chunk_size_ - size of a chunk in bytes before compression\n
+        _compress_ - compress chunks
+        
+        *Raises:*\n
+        Exception if the file is not written or checksums differ.
+        
+        *Example:*\n
+        | Put File  |  server  |  ${CURDIR}/setup.msi  |  C:\\temp\\setup.msi |
+        """
+
+        logger.info ('Put file %s to %s on server with alias "%s"'%(source, destination, alias))
+        self._session=self._cache.switch(alias)
+        self._in_shell(alias, self._session,
+                       lambda shell_id: self._put_file(self._session, shell_id, source, destination, chunk_size, compress))
+
+    def get_file (self, alias, source, destination, chunk_size=131072, compress=True):
+        """
+        Copy a file from remote mashine to local one.
+        
+        The file is received in chunks from the output of one power shell command,
+        each chunk is compressed with deflate if _compress_ is True. The checksum (SHA256)
+        of the remote file is compared with the checksum of the received file.
+        
+        *Args:*\n
+        _alias_ - robot framework alias to identify the session\n
+        _source_ - path to remote file\n
+        _destination_ - path to local file\n
+        _chunk_size_ - size of a chunk in bytes before compression\n
+        _compress_ - compress chunks
+        
+        *Raises:*\n
+        Exception if the file is not read or checksums differ.
+        
+        *Example:*\n
+        | Get File  |  server  |  C:\\app\\logs\\app.log  |  ${OUTPUT_DIR}/app.log |
+        """
+
+        logger.info ('Get file %s from server with alias "%s" to %s'%(source, alias, destination))
+        self._session=self._cache.switch(alias)
+        self._in_shell(alias, self._session,
+                       lambda shell_id: self._get_file(self._session, shell_id, source, destination, chunk_size, compress))
+
+    def put_file_to_hosts (self, source, destination, aliases=None, chunk_size=131072, compress=True, timeout=600, max_workers=10):
+        """
+        Copy a local file to several remote mashines concurrently.
+        
+        *Args:*\n
+        _source_ - path to local file\n
+        _destination_ - path to remote file\n
+        _aliases_ - list of session aliases; by default the file is copied to all sessions\n
+        _chunk_size_ - size of a chunk in bytes before compression\n
+        _compress_ - compress chunks\n
+        _timeout_ - maximum time of copying to one host, in seconds\n
+        _max_workers_ - maximum number of hosts processed at the same time
+        
+        *Returns:*\n
+        Dictionary with alias as a key and a dictionary as a value, see [#Run cmd on hosts|Run cmd on hosts];
+        std_out contains checksum of the written file.
+        
+        *Example:*\n
+        | ${results}=  |  Put File To Hosts  |  ${CURDIR}/setup.msi  |  C:\\temp\\setup.msi |
+        """
+
+        logger.info ('Put file %s to %s on servers %s'%(source, destination, aliases or 'ALL'))
+
+        def run(alias, session):
+            return self._in_shell(alias, session,
+                                  lambda shell_id: self._put_file(session, shell_id, source, destination, chunk_size, compress))
+
+        return self._run_on_hosts(run, aliases, timeout, max_workers)
+
+    def _put_file (self, session, shell_id, source, destination, chunk_size, compress):
+        """
+        Send a file to the standard input of power shell command in the shell.
+        """
+
+        compress=self._is_true(compress)
+        chunk_size=int(chunk_size)
+        script=PUT_FILE_SCRIPT.format(path=self._ps_quote(destination), compress='true' if compress else 'false')
+        command, params=self._ps_command(script)
+        protocol=session.protocol
+        checksum=hashlib.sha256()
+        command_id=protocol.run_command(shell_id, command, params, console_mode_stdin=False)
+        try:
+            with open(source, 'rb') as source_file:
+                while True:
+                    data=source_file.read(chunk_size)
+                    if not data:
+                        break
+                    checksum.update(data)
+                    if compress:
+                        compressor=zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+                        data=compressor.compress(data)+compressor.flush()
+                    protocol.send_command_input(shell_id, command_id, b64encode(data)+'\r\n')
+            protocol.send_command_input(shell_id, command_id, '', end=True)
+            std_out, std_err, status_code=protocol.get_command_output(shell_id, command_id)
+        finally:
+            protocol.cleanup_command(shell_id, command_id)
+        result=self._clean_ps_result(session, winrm.Response((std_out, std_err, status_code)))
+        if status_code!=0:
+            raise Exception('Could not write file %s: %s'%(destination, result.std_err))
+        if std_out.strip()!=checksum.hexdigest():
+            raise Exception('Checksum of file %s differs: %s, expected %s'%(destination, std_out.strip(), checksum.hexdigest()))
+        result.std_out=std_out.strip()
+        return result
+
+    def _get_file (self, session, shell_id, source, destination, chunk_size, compress):
+        """
+        Receive a file from the output of power shell command in the shell.
+        """
+
+        compress=self._is_true(compress)
+        script=GET_FILE_SCRIPT.format(path=self._ps_quote(source), chunk_size=int(chunk_size),
+                                      compress='true' if compress else 'false')
+        command, params=self._ps_command(script)
+        checksum=hashlib.sha256()
+        remote_checksum=None
+        status_code=None
+        std_err=[]
+        partial=''
+        with open(destination, 'wb') as destination_file:
+            for std_out, err, status_code, _done in self._iter_output(session, shell_id, command, params):
+                std_err.append(err)
+                lines=(partial+std_out).split('\n')
+                partial=lines.pop()
+                for line in lines:
+                    line=line.strip()
+                    if not line:
+                        continue
+                    if line.startswith('SHA256:'):
+                        remote_checksum=line[len('SHA256:'):]
+                        continue
+                    data=b64decode(line)
+                    if compress:
+                        data=zlib.decompress(data, -zlib.MAX_WBITS)
+                    checksum.update(data)
+                    destination_file.write(data)
+        if partial.strip().startswith('SHA256:'):
+            remote_checksum=partial.strip()[len('SHA256:'):]
+        result=self._clean_ps_result(session, winrm.Response(('', ''.join(std_err), status_code)))
+        if status_code!=0 or remote_checksum is None:
+            raise Exception('Could not read file %s: %s'%(source, result.std_err))
+        if remote_checksum!=checksum.hexdigest():
+            raise Exception('Checksum of file %s differs: %s, expected %s'%(destination, checksum.hexdigest(), remote_checksum))
+        return result
+
+    def _in_shell (self, alias, session, func):
+        """
+        Call func(shell_id) in the shell opened for alias or in a temporary shell.
+        """
+
+        shell_id=self._shells.get(alias)
+        if shell_id is not None:
+            return func(shell_id)
+        shell_id=session.protocol.open_shell()
+        try:
+            return func(shell_id)
+        finally:
+            session.protocol.close_shell(shell_id)
+
+    def _ps_quote (self, value):
+        """
+        Escaping of a value for single-quoted power shell string.
+        """
+
+        return value.replace("'", "''")
+
+    def _is_true (self, value):
+        """
+        Conversion of robot framework argument to bool.
+        """
+
+        if isinstance(value, basestring):
+            return value.lower() not in ('false', 'no', '0', '')
+        return bool(value)
+
+    def _shell (self, alias):
+        """
+        Identifier of the shell opened on server with alias.
+        """
+
+        if alias not in self._shells:
+            raise Exception('No shell is opened on server with alias "%s", use Open Shell'%alias)
+        return self._shells[alias]
+
+    def _run_in_shell (self, session, shell_id, command, params=()):
+        """
+        Execute command in the shell and get its result.
+        """
+
+        protocol=session.protocol
+        command_id=protocol.run_command(shell_id, command, params)
+        try:
+            std_out, std_err, status_code=protocol.get_command_output(shell_id, command_id)
+        finally:
+            protocol.cleanup_command(shell_id, command_id)
+        return winrm.Response((std_out, std_err, status_code))
+
+    def _ps_command (self, script):
+        """
+        Command and parameters to run power shell script, the same as used by winrm.Session.run_ps.
+        """
+
+        return 'powershell', ['-encodedcommand', b64encode(script.encode('utf_16_le')).decode('ascii')]
+
+    def _clean_ps_result (self, session, result):
+        """
+        Cleaning of power shell error message, the same as done by winrm.Session.run_ps.
+        """
+
+        if result.std_err and hasattr(session, '_clean_error_msg'):
+            result.std_err=session._clean_error_msg(result.std_err)
+        return result
+
+    def run_cmd_on_hosts (self, command, params=None, aliases=None, timeout=300, max_workers=10):
+        """
+        Execute the same command on several remote mashines concurrently.
+        
+        Commands are run by a pool of _max_workers_ threads, so the keyword takes about
+        the time of the slowest host. A shell opened by [#Open Shell|Open Shell] is used if there is one.
+        
+        *Args:*\n
+        _command_ -  windows command\n
+        _params_ - lists of command's parameters\n
+        _aliases_ - list of session aliases; by default the command is run on all sessions\n
+        _timeout_ - maximum time of the command on one host, in seconds\n
+        _max_workers_ - maximum number of hosts processed at the same time
+        
+        *Returns:*\n
+        Dictionary with alias as a key and a dictionary as a value:
+        | status_code | exit code of the command (None if it failed or timed out) |
+        | std_out | standard output |
+        | std_err | standard error |
+        | elapsed | execution time in seconds |
+        | error | error message (None if the command was executed) |
+        
+        *Example:*\n
+        | ${results}=  |  Run cmd on hosts  |  ipconfig  |  timeout=30 |
+        | Log  |  ${results['server']['std_out']} |
+        """
+
+        if params is None:
+            params=[]
+        logger.info ('Run command on servers %s: %s '%(aliases or 'ALL', ' '.join([command]+list(params))))
+
+        def run(alias, session):
+            if alias in self._shells:
+                return self._run_in_shell(session, self._shells[alias], command, params)
+            return session.run_cmd(command, params)
+
+        return self._run_on_hosts(run, aliases, timeout, max_workers)
+
+    def run_ps_on_hosts (self, script, aliases=None, timeout=300, max_workers=10):
+        """
+        Run the same power shell script on several remote mashines concurrently.
+        
+        *Args:*\n
+        _script_ -  power shell script\n
+        _aliases_ - list of session aliases; by default the script is run on all sessions\n
+        _timeout_ - maximum time of the script on one host, in seconds\n
+        _max_workers_ - maximum number of hosts processed at the same time
+        
+        *Returns:*\n
+        Dictionary with alias as a key and a dictionary as a value,
+        see [#Run cmd on hosts|Run cmd on hosts].
+        
+        *Example:*\n
+        | ${aliases}=  |  Create List  |  server1  |  server2 |
+        | ${results}=  |  Run ps on hosts  |  Stop-Service MyService  |  ${aliases} |
+        """
+
+        logger.info ('Run power shell script on servers %s: %s '%(aliases or 'ALL', script))
+
+        def run(alias, session):
+            if alias in self._shells:
+                result=self._run_in_shell(session, self._shells[alias], *self._ps_command(script))
+                return self._clean_ps_result(session, result)
+            return session.run_ps(script)
+
+        return self._run_on_hosts(run, aliases, timeout, max_workers)
+
+    def _run_on_hosts (self, run, aliases, timeout, max_workers):
+        """
+        Call run(alias, session) for several sessions in a bounded number of threads.
+        
+        Timeout of every host is counted from the start of its own call;
+        a host which exceeds it is reported and its thread is abandoned.
+        """
+
+        if aliases is None:
+            aliases=sorted(self._sessions.keys())
+        # every host is run once: results are keyed by alias
+        unique=[]
+        for alias in aliases:
+            if alias not in unique:
+                unique.append(alias)
+        aliases=unique
+        timeout=float(timeout)
+        slots=threading.Semaphore(int(max_workers))
+        lock=threading.Lock()
+        results={}
+        started={}
+
+        def worker(alias, session):
+            slots.acquire()
+            with lock:
+                started[alias]=time.time()
+            try:
+                result=run(alias, session)
+                outcome={'status_code': result.status_code, 'std_out': result.std_out,
+                         'std_err': result.std_err, 'error': None}
+            except Exception, e:
+                outcome={'status_code': None, 'std_out': '', 'std_err': '', 'error': str(e)}
+            with lock:
+                if alias not in results:
+                    outcome['elapsed']=time.time()-started[alias]
+                    results[alias]=outcome
+                    slots.release()
+
+        for alias in aliases:
+            thread=threading.Thread(target=worker, args=(alias, self._sessions[alias]))
+            thread.daemon=True
+            thread.start()
+        while True:
+            with lock:
+                now=time.time()
+                for alias, start in started.items():
+                    if alias not in results and now-start>timeout:
+                        results[alias]={'status_code': None, 'std_out': '', 'std_err': '', 'elapsed': now-start,
+                                        'error': 'Timeout %s seconds exceeded'%timeout}
+                        # the slot of the abandoned thread is given to the next host
+                        slots.release()
+                if len(results)==len(aliases):
+                    break
+            time.sleep(0.1)
+        failed=[alias for alias in aliases if results[alias]['error'] is not None]
+        if failed:
+            logger.warn ('Execution failed on servers: %s'%', '.join(failed))
+        return results
+
     def delete_all_sessions(self):
         """ Removes all sessions with windows hosts"""
 
-        self._cache.empty_cache()
\ No newline at end of file
+        for alias in self._shells.keys():
+            try:
+                self.close_shell(alias)
+            except Exception, e:
+                logger.warn ('Could not close shell on server with alias "%s": %s'%(alias, e))
+        self._cache.empty_cache()
+        self._sessions={}
\ No newline at end of file
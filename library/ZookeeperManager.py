@@ -1,7 +1,24 @@
 # -*- coding: utf-8 -*-
 from robot.libraries.BuiltIn import BuiltIn
+from robot.utils import ConnectionCache, timestr_to_secs
 from kazoo.client import KazooClient
-from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import NoNodeError, NotEmptyError, RolledBackError
+from kazoo.recipe.watchers import DataWatch, ChildrenWatch
+from kazoo.recipe.cache import TreeCache, TreeEvent
+from robot.api import logger
+import base64
+import fnmatch
+import json
+import threading
+import time
+import uuid
+import zlib
+
+try:
+    import yaml
+except ImportError:
+    # yaml is needed only for export/import of subtrees in yaml files
+    yaml = None
 
 class ZookeeperManager(object):
     """
@@ -14,39 +31,161 @@ class ZookeeperManager(object):
     == Dependence ==
     | robot framework   | http://robotframework.org           |
     | kazoo             | https://github.com/python-zk/kazoo  |
+    | PyYAML            | https://pypi.python.org/pypi/PyYAML (optional, for yaml files in Export Subtree / Import Subtree) |
     """
 
     ROBOT_LIBRARY_SCOPE='GLOBAL'
 
+    # prefixes of values stored by Create Node and Set Value with compression or chunking
+    _COMPRESSED_MARKER = '\x00zlib\x00'
+    _CHUNKED_MARKER = '\x00chunked\x00'
+    _CHUNK_PREFIX = '__chunk_'
+    # attempts to read chunks of a value which is being replaced concurrently
+    _CHUNK_READ_ATTEMPTS = 3
+    # limit of data size in one transaction (Zookeeper request limit is 1 MB)
+    _TRANSACTION_MAX_BYTES = 900000
+
     def __init__(self):
         self.bi = BuiltIn()
+        self.zk = None
+        self._cache = ConnectionCache('No connections to Zookeeper')
+        # aliases, stopped connections and tree caches by connection index
+        self._aliases = {}
+        self._stopped = set()
+        self._tree_caches = {}
+        self._transaction = None
 
-    def connect_to_zookeeper(self, hosts, timeout=10):
+    def connect_to_zookeeper(self, hosts, timeout=10, alias=None):
         """
         Connecting to Zookeeper
 
         *Args:*\n
         _host_ - comma-separated list of hosts to connect.\n
         _timeout_ - connection timeout in seconds. Default timeout is 10 seconds.\n
+        _alias_ - connection alias.\n
+
+        *Returns:*\n
+        Index of the connection.
 
         *Example:*\n
         | Connect To Zookeeper | host1:2181, host2 | 25 |
+        | Connect To Zookeeper | host3:2181 | alias=second |
         """
         self.zk = KazooClient(hosts, timeout)
         self.zk.start()
+        index = self._cache.register(self.zk, alias)
+        self._aliases[index] = alias
+        return index
+
+    def switch_zookeeper_connection(self, index_or_alias):
+        """
+        Switch between connections to Zookeeper using their index or alias.
+
+        Alias is set in [#Connect To Zookeeper|Connect To Zookeeper], which also returns the index of the connection.
+
+        *Args:*\n
+        _index_or_alias_ - index or alias of the connection.
+
+        *Returns:*\n
+        Index of the previous connection.
+
+        *Example:*\n
+        | Connect To Zookeeper | host1:2181 | alias=first |
+        | Connect To Zookeeper | host2:2181 | alias=second |
+        | Switch Zookeeper Connection | first |
+        | ${value}= | Get Value | /my/favorite/node |
+        """
+        old_index = self._cache.current_index
+        self.zk = self._cache.switch(index_or_alias)
+        return old_index
 
     def disconnect_from_zookeeper(self):
         """
-        Close all connections to Zookeeper
+        Close the current connection to Zookeeper
 
         *Example:*\n
         | Connect To Zookeeper | 127.0.0.1: 2181 |
         | Disconnect From Zookeeper |
         """
+        self.disable_cache()
         self.zk.stop()
         self.zk.close()
+        self._stopped.add(self._cache.current_index)
+
+    def close_all_zookeeper_connections(self):
+        """
+        Close all connections to Zookeeper.
+
+        After this keyword the index returned by [#Connect To Zookeeper|Connect To Zookeeper] starts from 1.
 
-    def create_node(self, path, value='', force=False):
+        *Example:*\n
+        | Connect To Zookeeper | host1:2181 | alias=first |
+        | Connect To Zookeeper | host2:2181 | alias=second |
+        | Close All Zookeeper Connections |
+        """
+        for _root, cache in self._tree_caches.values():
+            cache.close()
+        for index, client in enumerate(self._cache, 1):
+            if index not in self._stopped:
+                client.stop()
+                client.close()
+        self._cache.empty_cache()
+        self.zk = None
+        self._aliases = {}
+        self._stopped = set()
+        self._tree_caches = {}
+
+    def read_from_all_zookeeper_connections(self, path, operation='value'):
+        """
+        Run the same read on all opened connections to Zookeeper at once.
+
+        Requests are sent to all ensembles asynchronously and then their results are gathered,
+        so the keyword takes the time of the slowest ensemble.
+
+        *Args:*\n
+        _path_ - node path.\n
+        _operation_ - what to read: value, children or exists. Default value is "value".
+
+        *Returns:*\n
+        Dictionary with alias (index, if the connection has no alias) as a key and the result as a value.
+        The result is None if the node doesn't exist (FALSE for "exists").
+
+        *Example:*\n
+        | Connect To Zookeeper | host1:2181 | alias=first |
+        | Connect To Zookeeper | host2:2181 | alias=second |
+        | ${values}= | Read From All Zookeeper Connections | /my/favorite/node |
+        | Should Be Equal | ${values['first']} | ${values['second']} |
+        """
+        requests = []
+        for index, client in enumerate(self._cache, 1):
+            if index in self._stopped:
+                continue
+            if operation == 'value':
+                request = client.get_async(path)
+            elif operation == 'children':
+                request = client.get_children_async(path)
+            elif operation == 'exists':
+                request = client.exists_async(path)
+            else:
+                raise Exception('Unknown operation %s, expected value, children or exists' % operation)
+            name = self._aliases[index] if self._aliases[index] is not None else str(index)
+            requests.append((name, client, request))
+        results = {}
+        for name, client, request in requests:
+            try:
+                result = request.get()
+            except NoNodeError:
+                result = None
+            if operation == 'value' and result is not None:
+                result = self._unpack_value(path, result[0] or '', client)
+            elif operation == 'children' and result is not None:
+                result = self._visible_children(result)
+            elif operation == 'exists':
+                result = result is not None
+            results[name] = result
+        return results
+
+    def create_node(self, path, value='', force=False, encoding='utf-8', compress=False, chunk_size=0):
         """
         Create a node with a value.
 
@@ -54,6 +193,11 @@ class ZookeeperManager(object):
         _path_ - node path.\n
         _value_ - node value. Default is an empty string.\n
         _force_ - if TRUE parent path will be created. Default value is FALSE.\n
+        _encoding_ - how to convert the value to bytes: utf-8 (text), raw (byte string as is),
+                     base64 (base64 string is decoded), json (value is serialized to json). Default value is utf-8.\n
+        _compress_ - if TRUE the value is compressed with zlib. Default value is FALSE.\n
+        _chunk_size_ - if greater than 0 and the value is larger, the value is split into child nodes
+                       of this size (named __chunk_NNNNNN). Default value is 0 (no chunking).\n
 
         *Raises:*\n
         _NodeExistError_ - node already exists.\n
@@ -63,14 +207,22 @@ class ZookeeperManager(object):
         
         *Example:*\n
         | Create Node  |  /my/favorite/node  |  my_value |  ${TRUE} |
+        | Create Node  |  /my/big/config  |  ${config}  |  encoding=json  |  compress=${TRUE}  |  chunk_size=500000 |
         """
-        string_value = value.encode('utf-8')
-        self.zk.create(path, string_value, None, False, False, force)
+        data = self._pack_value(value, encoding, compress)
+        chunk_size = int(chunk_size)
+        if chunk_size > 0 and len(data) > chunk_size:
+            self.zk.create(path, '', None, False, False, force)
+            self._write_chunks(path, data, chunk_size)
+        else:
+            self.zk.create(path, data, None, False, False, force)
 
     def delete_node(self, path, force=False):
         """
         Delete a node.
 
+        Chunks of a value stored by [#Create Node|Create Node] with _chunk_size_ are deleted together with the node.
+
         *Args:*\n
         _path_ - node path.\n
         _force_ - if TRUE and node exists - recursively delete a node with all its children, 
@@ -88,6 +240,15 @@ class ZookeeperManager(object):
                 pass
             else:
                 raise
+        except NotEmptyError:
+            children = self.zk.get_children(path)
+            if not children or self._visible_children(children):
+                raise
+            transaction = self.zk.transaction()
+            for child in children:
+                transaction.delete(path.rstrip('/') + '/' + child)
+            transaction.delete(path)
+            self._commit_transaction(transaction)
 
     def exists(self, path):
         """
@@ -99,6 +260,9 @@ class ZookeeperManager(object):
         *Returns:*\n
         TRUE if a node exists, FALSE in other way.
         """
+        cache = self._cache_for(path)
+        if cache is not None:
+            return cache.get_data(path) is not None
         node_stat = self.zk.exists(path)
         if (node_stat != None):
             #Node exists
@@ -107,7 +271,7 @@ class ZookeeperManager(object):
             #Node doesn't exist
             return False
 
-    def set_value(self, path, value, force=False):
+    def set_value(self, path, value, force=False, encoding='utf-8', compress=False, chunk_size=0):
         """
         Set the value of a node.
 
@@ -115,22 +279,38 @@ class ZookeeperManager(object):
         _path_ - node path.\n
         _value_ - new value.\n
         _force_ - if TRUE path will be created. Default value is FALSE.\n
+        _encoding_ - utf-8, raw, base64 or json, see [#Create Node|Create Node]. Default value is utf-8.\n
+        _compress_ - if TRUE the value is compressed with zlib. Default value is FALSE.\n
+        _chunk_size_ - if greater than 0 and the value is larger, the value is split into child nodes
+                       of this size, see [#Create Node|Create Node]. Default value is 0 (no chunking).\n
 
         *Raises:*\n
         _NoNodeError - node doesn't exist.\n
         _ZookeeperError - value is too large or server returns non-zero error code.
         """
-        string_value = value.encode('utf-8')
+        data = self._pack_value(value, encoding, compress)
         if (force):
             self.zk.ensure_path(path)
-        self.zk.set(path, string_value)
+        chunk_size = int(chunk_size)
+        if chunk_size > 0 and len(data) > chunk_size:
+            self._write_chunks(path, data, chunk_size)
+        else:
+            node_stat = self.zk.set(path, data)
+            if node_stat.numChildren:
+                # chunks of the previous value are not needed any more
+                self._delete_chunks(path, self.zk.get_children(path))
 
-    def get_value(self, path):
+    def get_value(self, path, encoding='raw'):
         """
         Get the value of a node.
 
+        Values compressed or split into chunks by [#Create Node|Create Node] and [#Set Value|Set Value]
+        are decompressed and reassembled.
+
         *Args:*\n
-        _path_ - node path.
+        _path_ - node path.\n
+        _encoding_ - how to convert the value: raw (byte string as is), utf-8 (text), base64 (base64 string),
+                     json (deserialized object). Default value is raw.
 
         *Returns:*\n
         Value of a node.
@@ -139,8 +319,159 @@ class ZookeeperManager(object):
         _NoNodeError_ - node doesn't exist.\n
         _ZookeeperError_ - server returns a non-zero error code.
         """
-        value, _stat = self.zk.get(path)
-        return value
+        data = self._read_data(path)
+        return self._decode_value(self._unpack_value(path, data), encoding)
+
+    def _read_data(self, path, client=None):
+        """
+        Read a stored value of a node, from the tree cache if it is enabled.
+        """
+        if client is None:
+            cache = self._cache_for(path)
+            if cache is not None:
+                node = cache.get_data(path)
+                if node is None:
+                    raise NoNodeError(path)
+                return node.data or ''
+            client = self.zk
+        value, _stat = client.get(path)
+        return value or ''
+
+    def _read_data_async(self, paths, client=None):
+        """
+        Read stored values of many nodes at once.
+        """
+        if client is None:
+            if paths and self._cache_for(paths[0]) is not None:
+                return [self._read_data(path) for path in paths]
+            client = self.zk
+        requests = [client.get_async(path) for path in paths]
+        return [request.get()[0] or '' for request in requests]
+
+    def _unpack_value(self, path, data, client=None):
+        """
+        Restore a value stored by Create Node or Set Value: reassemble chunks and decompress.
+
+        Every read of node values goes through this method, so compression and chunking
+        are transparent for all keywords. If the value is replaced while its chunks are read,
+        the new header is read and reading is repeated.
+
+        *Args:*\n
+        _path_ - node path.\n
+        _data_ - stored value of the node.\n
+        _client_ - connection to read chunks from; current connection (or its tree cache) by default.
+        """
+        attempt = 1
+        while data.startswith(self._CHUNKED_MARKER):
+            generation, count = self._parse_chunk_header(data)
+            try:
+                data = ''.join(self._read_data_async(self._chunk_paths(path, generation, count), client))
+                break
+            except NoNodeError:
+                if attempt >= self._CHUNK_READ_ATTEMPTS:
+                    raise
+                attempt += 1
+                data = self._read_data(path, client)
+        if data.startswith(self._COMPRESSED_MARKER):
+            data = zlib.decompress(data[len(self._COMPRESSED_MARKER):])
+        return data
+
+    def _parse_chunk_header(self, data):
+        """
+        Get generation and count of chunks from a header of a chunked value.
+        Headers without generation (<count>) are written by older versions of the library.
+        """
+        header = data[len(self._CHUNKED_MARKER):]
+        if ':' in header:
+            generation, count = header.split(':', 1)
+            return generation, int(count)
+        return '', int(header)
+
+    def _chunk_paths(self, path, generation, count):
+        """
+        Paths of child nodes with chunks of a value.
+        """
+        if generation:
+            return ['%s/%s%s_%06d' % (path.rstrip('/'), self._CHUNK_PREFIX, generation, index) for index in range(count)]
+        return ['%s/%s%06d' % (path.rstrip('/'), self._CHUNK_PREFIX, index) for index in range(count)]
+
+    def _visible_children(self, children):
+        """
+        Filter out child nodes with chunks of values.
+        """
+        return [child for child in children if not child.startswith(self._CHUNK_PREFIX)]
+
+    def _delete_chunks(self, path, children):
+        """
+        Delete child nodes with chunks of values in one transaction.
+        """
+        chunks = [child for child in children if child.startswith(self._CHUNK_PREFIX)]
+        if not chunks:
+            return
+        transaction = self.zk.transaction()
+        for child in chunks:
+            transaction.delete(path.rstrip('/') + '/' + child)
+        self._commit_transaction(transaction)
+
+    def _write_chunks(self, path, data, chunk_size):
+        """
+        Split data into child nodes and set a header with their generation and count as the value of the node.
+
+        New chunks are created under fresh names (a new generation) by transactions of limited size.
+        The last transaction switches the header and deletes chunks of the previous value,
+        so readers see either the old or the new value, never a mix of them.
+        """
+        chunks = [data[start:start + chunk_size] for start in range(0, len(data), chunk_size)]
+        old_chunks = [child for child in self.zk.get_children(path) if child.startswith(self._CHUNK_PREFIX)]
+        generation = uuid.uuid4().hex[:12]
+        chunk_paths = self._chunk_paths(path, generation, len(chunks))
+        transaction = self.zk.transaction()
+        transaction_size = 0
+        for chunk_path, chunk in zip(chunk_paths, chunks):
+            if transaction_size and transaction_size + len(chunk) > self._TRANSACTION_MAX_BYTES:
+                self._commit_transaction(transaction)
+                transaction = self.zk.transaction()
+                transaction_size = 0
+            transaction.create(chunk_path, chunk)
+            transaction_size += len(chunk)
+        self._commit_transaction(transaction)
+        transaction = self.zk.transaction()
+        transaction.set_data(path, '%s%s:%d' % (self._CHUNKED_MARKER, generation, len(chunks)))
+        for child in old_chunks:
+            transaction.delete(path.rstrip('/') + '/' + child)
+        self._commit_transaction(transaction)
+
+    def _pack_value(self, value, encoding, compress):
+        """
+        Convert a value to bytes and compress it if needed.
+        """
+        if encoding == 'utf-8':
+            data = value.encode('utf-8')
+        elif encoding == 'raw':
+            data = value
+        elif encoding == 'base64':
+            data = base64.b64decode(value)
+        elif encoding == 'json':
+            data = json.dumps(value)
+        else:
+            raise Exception('Unknown encoding %s, expected utf-8, raw, base64 or json' % encoding)
+        if compress:
+            data = self._COMPRESSED_MARKER + zlib.compress(data)
+        return data
+
+    def _decode_value(self, data, encoding):
+        """
+        Convert bytes of a value according to the encoding.
+        """
+        if encoding == 'raw':
+            return data
+        if encoding == 'utf-8':
+            return data.decode('utf-8')
+        if encoding == 'base64':
+            return base64.b64encode(data)
+        if encoding == 'json':
+            return json.loads(data)
+        raise Exception('Unknown encoding %s, expected raw, utf-8, base64 or json' % encoding)
 
     def get_children(self, path):
         """
@@ -150,11 +481,531 @@ class ZookeeperManager(object):
         _path_ - node path.
 
         *Returns:*\n
-        List of node's children.
+        List of node's children. Child nodes with chunks of a value are not listed.
 
         *Raises:*\n
         _NoNodeError_ - node doesn't exist.\n
         _ZookeeperError_ - server returns a non-zero error code.
         """
+        cache = self._cache_for(path)
+        if cache is not None:
+            children = cache.get_children(path)
+            if children is None:
+                raise NoNodeError(path)
+            return sorted(self._visible_children(children))
         children = self.zk.get_children(path)
-        return children
\ No newline at end of file
+        return self._visible_children(children)
+
+    def get_values(self, paths):
+        """
+        Get values of many nodes at once.
+
+        Requests for all nodes are sent asynchronously and then their results are gathered,
+        so the keyword takes about one round trip instead of one per node.
+
+        *Args:*\n
+        _paths_ - list of node paths or a path pattern. Pattern may contain wildcards *, ? and [...]
+        in any path segment, a wildcard matches only within one segment (e.g. /services/*/config/port).
+
+        *Returns:*\n
+        Dictionary with node paths as keys and values as values.
+        Value is None for listed nodes which don't exist; such nodes are listed in a warning.
+        Only existing nodes are returned for a pattern.
+
+        *Raises:*\n
+        _ZookeeperError_ - server returns a non-zero error code.
+
+        *Example:*\n
+        | ${paths}=  |  Create List  |  /my/node1  |  /my/node2 |
+        | ${values}=  |  Get Values  |  ${paths} |
+        | ${ports}=  |  Get Values  |  /services/*/config/port |
+        """
+        is_pattern = isinstance(paths, basestring)
+        if is_pattern:
+            paths = self._find_nodes(paths)
+        requests = [(path, self.zk.get_async(path)) for path in paths]
+        values = {}
+        missing = []
+        for path, request in requests:
+            try:
+                value, _stat = request.get()
+                values[path] = self._unpack_value(path, value or '')
+            except NoNodeError:
+                if not is_pattern:
+                    values[path] = None
+                    missing.append(path)
+        if missing:
+            logger.warn('Nodes do not exist: %s' % ', '.join(missing))
+        return values
+
+    def _find_nodes(self, pattern):
+        """
+        Find paths of nodes matching a pattern with wildcards in path segments.
+        Children of all nodes of a level are requested at once.
+        """
+        segments = pattern.strip('/').split('/')
+        level = ['']
+        for segment in segments:
+            if not any(char in segment for char in '*?['):
+                level = [parent + '/' + segment for parent in level]
+                continue
+            requests = [(parent, self.zk.get_children_async(parent or '/')) for parent in level]
+            level = []
+            for parent, request in requests:
+                try:
+                    children = request.get()
+                except NoNodeError:
+                    continue
+                level.extend(parent + '/' + child for child in sorted(fnmatch.filter(self._visible_children(children), segment)))
+        return level
+
+    def enable_cache(self, path, timeout=10):
+        """
+        Keep a local copy of a node and all its descendants.
+
+        After the cache is enabled [#Get Value|Get Value], [#Get Children|Get Children] and [#Exists|Exists]
+        for nodes under _path_ are answered from memory. The copy is updated by Zookeeper watch
+        notifications (kazoo TreeCache), so changes become visible with a small delay:
+        a value written just before reading it may still be the old one.
+
+        Only one cache can be enabled for a connection, the previous one is disabled.
+
+        *Args:*\n
+        _path_ - path of the root node.\n
+        _timeout_ - maximum time to wait for the initial loading of the tree, in seconds or in Robot Framework time format. Default value is 10 seconds.
+
+        *Raises:*\n
+        _AssertionError_ - the tree is not loaded after timeout.
+
+        *Example:*\n
+        | Enable Cache  |  /my/service/config |
+        | ${value}=  |  Get Value  |  /my/service/config/timeout |
+        | Disable Cache |
+        """
+        self.disable_cache()
+        initialized = threading.Event()
+
+        def listener(event):
+            if event.event_type == TreeEvent.INITIALIZED:
+                initialized.set()
+
+        cache = TreeCache(self.zk, path)
+        cache.listen(listener)
+        cache.start()
+        if not initialized.wait(timestr_to_secs(timeout)):
+            cache.close()
+            raise AssertionError('Cache of %s is not initialized' % path)
+        self._tree_caches[self._cache.current_index] = (path.rstrip('/'), cache)
+
+    def disable_cache(self):
+        """
+        Stop using the local copy of nodes enabled by [#Enable Cache|Enable Cache] for the current connection.
+
+        *Example:*\n
+        | Disable Cache |
+        """
+        if self._cache.current_index in self._tree_caches:
+            _root, cache = self._tree_caches.pop(self._cache.current_index)
+            cache.close()
+
+    def _cache_for(self, path):
+        """
+        Get the tree cache if the node is under the cached root.
+        """
+        if self._cache.current_index not in self._tree_caches:
+            return None
+        root, cache = self._tree_caches[self._cache.current_index]
+        if path == root or path.startswith(root + '/'):
+            return cache
+        return None
+
+    def wait_until_node_exists(self, path, timeout=10):
+        """
+        Wait until a node is created.
+
+        The keyword is based on Zookeeper watches: no requests are sent while waiting,
+        the keyword returns as soon as the server notifies about the change.
+
+        *Args:*\n
+        _path_ - node path.\n
+        _timeout_ - maximum time to wait, in seconds or in Robot Framework time format. Default value is 10 seconds.
+
+        *Raises:*\n
+        _AssertionError_ - node doesn't exist after timeout.
+
+        *Example:*\n
+        | Wait Until Node Exists  |  /services/my_service/instance  |  1 min |
+        """
+        self._wait_for_data(path, lambda data, stat: stat is not None, timeout,
+                            'Node %s does not exist' % path)
+
+    def wait_until_node_deleted(self, path, timeout=10):
+        """
+        Wait until a node is deleted.
+
+        *Args:*\n
+        _path_ - node path.\n
+        _timeout_ - maximum time to wait, in seconds or in Robot Framework time format. Default value is 10 seconds.
+
+        *Raises:*\n
+        _AssertionError_ - node still exists after timeout.
+
+        *Example:*\n
+        | Wait Until Node Deleted  |  /services/my_service/instance  |  30s |
+        """
+        self._wait_for_data(path, lambda data, stat: stat is None, timeout,
+                            'Node %s is not deleted' % path)
+
+    def wait_until_node_value_equals(self, path, value, timeout=10):
+        """
+        Wait until a node exists and has the value.
+
+        *Args:*\n
+        _path_ - node path.\n
+        _value_ - expected value.\n
+        _timeout_ - maximum time to wait, in seconds or in Robot Framework time format. Default value is 10 seconds.
+
+        *Raises:*\n
+        _AssertionError_ - node value differs from the expected one after timeout.
+
+        *Example:*\n
+        | Wait Until Node Value Equals  |  /services/my_service/state  |  ready |
+        """
+        string_value = value.encode('utf-8')
+
+        def condition(data, stat):
+            if stat is None:
+                return False
+            try:
+                return self._unpack_value(path, data or '', self.zk) == string_value
+            except NoNodeError:
+                # node was deleted while its chunks were read
+                return False
+
+        self._wait_for_data(path, condition, timeout, 'Value of node %s is not equal to %s' % (path, value))
+
+    def wait_until_children_count(self, path, count, timeout=10):
+        """
+        Wait until a node exists and has the number of children.
+
+        *Args:*\n
+        _path_ - node path.\n
+        _count_ - expected number of children.\n
+        _timeout_ - maximum time to wait, in seconds or in Robot Framework time format. Default value is 10 seconds.
+
+        *Raises:*\n
+        _AssertionError_ - number of children differs from the expected one after timeout.
+
+        *Example:*\n
+        | Wait Until Children Count  |  /services/my_service  |  3  |  2 min |
+        """
+        count = int(count)
+        deadline = time.time() + timestr_to_secs(timeout)
+        message = 'Node %s does not have %d children' % (path, count)
+        self._wait_for_data(path, lambda data, stat: stat is not None, timeout, message)
+        self._wait_for_watch(ChildrenWatch, path, lambda children: len(self._visible_children(children)) == count,
+                             deadline - time.time(), message)
+
+    def _wait_for_data(self, path, condition, timeout, message):
+        """
+        Wait until node data satisfies the condition, using DataWatch.
+
+        *Args:*\n
+        _condition_ - function of node data and node stat (None if node doesn't exist).
+        """
+        self._wait_for_watch(DataWatch, path, condition, timestr_to_secs(timeout), message)
+
+    def _wait_for_watch(self, watch_class, path, condition, timeout, message):
+        """
+        Wait until a watch callback gets arguments satisfying the condition.
+        The watch is stopped and its session listener is removed after the condition is met or after timeout;
+        a Zookeeper watch already set on the node is dropped by kazoo when it fires.
+        """
+        satisfied = threading.Event()
+        expired = threading.Event()
+
+        def check(*args):
+            if expired.is_set():
+                return False
+            if condition(*args):
+                satisfied.set()
+                return False
+
+        # kazoo passes the event to callbacks which accept more arguments, so arity is fixed here
+        if watch_class is ChildrenWatch:
+            callback = lambda children: check(children)
+        else:
+            callback = lambda data, stat: check(data, stat)
+        watch = watch_class(self.zk, path, callback)
+        if not satisfied.wait(max(timeout, 0)):
+            expired.set()
+            # kazoo has no public method to stop a watch, this is what it does when the callback returns False
+            with watch._run_lock:
+                watch._stopped = True
+                watch._func = None
+            self.zk.remove_listener(watch._session_watcher)
+            raise AssertionError(message)
+
+    def begin_transaction(self):
+        """
+        Start a transaction.
+
+        Operations added to the transaction are sent to the server in one request by
+        [#Commit Transaction|Commit Transaction] and are applied all together or not at all.
+
+        *Example:*\n
+        | Begin Transaction |
+        | Add Create Node To Transaction  |  /my/favorite/node  |  my_value |
+        | Add Set Value To Transaction  |  /my/other/node  |  new_value |
+        | Add Delete Node To Transaction  |  /my/old/node |
+        | Commit Transaction |
+        """
+        self._transaction = self.zk.transaction()
+
+    def add_create_node_to_transaction(self, path, value=''):
+        """
+        Add node creation to the current transaction.
+
+        *Args:*\n
+        _path_ - node path.\n
+        _value_ - node value. Default is an empty string.
+
+        *Example:*\n
+        | Add Create Node To Transaction  |  /my/favorite/node  |  my_value |
+        """
+        self._current_transaction().create(path, value.encode('utf-8'))
+
+    def add_set_value_to_transaction(self, path, value, version=-1):
+        """
+        Add setting of a node value to the current transaction.
+
+        *Args:*\n
+        _path_ - node path.\n
+        _value_ - new value.\n
+        _version_ - expected node version, -1 matches any version. Default value is -1.
+
+        *Example:*\n
+        | Add Set Value To Transaction  |  /my/favorite/node  |  new_value |
+        """
+        self._current_transaction().set_data(path, value.encode('utf-8'), int(version))
+
+    def add_delete_node_to_transaction(self, path, version=-1):
+        """
+        Add node deletion to the current transaction.
+
+        *Args:*\n
+        _path_ - node path.\n
+        _version_ - expected node version, -1 matches any version. Default value is -1.
+
+        *Example:*\n
+        | Add Delete Node To Transaction  |  /my/favorite/node |
+        """
+        self._current_transaction().delete(path, int(version))
+
+    def add_check_version_to_transaction(self, path, version):
+        """
+        Add node version check to the current transaction.
+        The transaction fails if the node version differs from _version_.
+
+        *Args:*\n
+        _path_ - node path.\n
+        _version_ - expected node version.
+
+        *Example:*\n
+        | Add Check Version To Transaction  |  /my/favorite/node  |  3 |
+        """
+        self._current_transaction().check(path, int(version))
+
+    def commit_transaction(self):
+        """
+        Send all operations of the current transaction to the server in one request.
+
+        *Returns:*\n
+        List of operation results.
+
+        *Raises:*\n
+        Error of the first failed operation (e.g. _NodeExistsError_, _NoNodeError_, _BadVersionError_).
+        No operation of the transaction is applied in this case.
+
+        *Example:*\n
+        | ${results}=  |  Commit Transaction |
+        """
+        transaction = self._current_transaction()
+        self._transaction = None
+        return self._commit_transaction(transaction)
+
+    def _current_transaction(self):
+        """
+        Get the transaction started by Begin Transaction.
+        """
+        if self._transaction is None:
+            raise Exception('Transaction is not started, use Begin Transaction')
+        return self._transaction
+
+    def export_subtree(self, path, filename):
+        """
+        Save a node and all its descendants to a json or yaml file.
+
+        The tree is read level by level: requests for all nodes of a level are sent at once
+        (kazoo async API), so the number of round trips is equal to the depth of the tree.
+        Compressed and chunked values are restored; values are saved as utf-8 strings,
+        values which are not valid utf-8 are saved as {"base64": "<base64 of the value>"}.
+
+        *Args:*\n
+        _path_ - path of the root node.\n
+        _filename_ - file name; yaml is used for *.yaml and *.yml files, json otherwise.
+
+        *Returns:*\n
+        Number of exported nodes.
+
+        *Raises:*\n
+        _NoNodeError_ - root node doesn't exist.\n
+        _ZookeeperError_ - server returns a non-zero error code.
+
+        *Example:*\n
+        | Export Subtree  |  /my/service/config  |  ${OUTPUT_DIR}/config.json |
+        =>\n
+        | {"/": "", "/db": "", "/db/url": "jdbc:oracle:thin:@db:1521/orcl", "/key": {"base64": "AAECAw=="}, "/timeout": "30"}
+        """
+        nodes = self._read_subtree(path)
+        tree = {}
+        for name, value in nodes.items():
+            try:
+                tree[name] = value.decode('utf-8')
+            except UnicodeDecodeError:
+                tree[name] = {'base64': base64.b64encode(value)}
+        with open(filename, 'w') as subtree_file:
+            if self._is_yaml(filename):
+                yaml.safe_dump(tree, subtree_file, default_flow_style=False, allow_unicode=True)
+            else:
+                json.dump(tree, subtree_file, indent=2, sort_keys=True)
+        return len(tree)
+
+    def import_subtree(self, filename, path, overwrite=False, batch_size=100):
+        """
+        Create nodes from a file saved by [#Export Subtree|Export Subtree].
+
+        Nodes are written by transactions of at most _batch_size_ operations and 900 KB of data,
+        parents before children. Missing parents of the root node are created.
+        Values saved as {"base64": ...} are decoded. Values too large for one request are compressed
+        and, if still too large, split into chunks as by [#Create Node|Create Node].
+
+        *Args:*\n
+        _filename_ - file name; yaml is used for *.yaml and *.yml files, json otherwise.\n
+        _path_ - path of the root node to restore the tree to.\n
+        _overwrite_ - if TRUE values of existing nodes are replaced, otherwise existing nodes raise an error. Default value is FALSE.\n
+        _batch_size_ - maximum number of operations in one transaction. Default value is 100.
+
+        *Returns:*\n
+        Number of imported nodes.
+
+        *Raises:*\n
+        _NodeExistsError_ - node already exists and _overwrite_ is FALSE.\n
+        _ZookeeperError_ - value is too large or server returns a non-zero error code.
+
+        *Example:*\n
+        | Import Subtree  |  ${OUTPUT_DIR}/config.json  |  /my/service/config  |  overwrite=${TRUE} |
+        """
+        with open(filename) as subtree_file:
+            if self._is_yaml(filename):
+                tree = yaml.safe_load(subtree_file)
+            else:
+                tree = json.load(subtree_file)
+        root = path.rstrip('/')
+        nodes = sorted(tree.items(), key=lambda item: (item[0].rstrip('/').count('/'), item[0]))
+        nodes = [(root + name.rstrip('/') or '/', self._subtree_value(value)) for name, value in nodes]
+        parent = root.rsplit('/', 1)[0]
+        if parent:
+            self.zk.ensure_path(parent)
+        existing = set()
+        if overwrite:
+            requests = [(node_path, self.zk.exists_async(node_path)) for node_path, _value in nodes]
+            existing = set(node_path for node_path, request in requests if request.get() is not None)
+        batch_size = int(batch_size)
+        chunked = []
+        transaction = self.zk.transaction()
+        operations = 0
+        transaction_size = 0
+        for node_path, value in nodes:
+            if len(value) > self._TRANSACTION_MAX_BYTES:
+                value = self._pack_value(value, 'raw', True)
+                if len(value) > self._TRANSACTION_MAX_BYTES:
+                    # chunks are written after the node is created
+                    chunked.append((node_path, value))
+                    if node_path in existing:
+                        continue
+                    value = ''
+            if operations and (operations >= batch_size or transaction_size + len(value) > self._TRANSACTION_MAX_BYTES):
+                self._commit_transaction(transaction)
+                transaction = self.zk.transaction()
+                operations = 0
+                transaction_size = 0
+            if node_path in existing:
+                transaction.set_data(node_path, value)
+            else:
+                transaction.create(node_path, value)
+            operations += 1
+            transaction_size += len(value)
+        if operations:
+            self._commit_transaction(transaction)
+        for node_path, value in chunked:
+            self._write_chunks(node_path, value, self._TRANSACTION_MAX_BYTES)
+        return len(nodes)
+
+    def _subtree_value(self, value):
+        """
+        Convert a value loaded from a file saved by Export Subtree to bytes.
+        """
+        if isinstance(value, dict):
+            return base64.b64decode(value['base64'])
+        return (u'%s' % ('' if value is None else value)).encode('utf-8')
+
+    def _read_subtree(self, path):
+        """
+        Read values of a node and all its descendants, level by level.
+
+        *Returns:*\n
+        Dictionary with paths relative to _path_ ("/" for the root node) and values.
+        """
+        root = path.rstrip('/')
+        nodes = {}
+        level = [path]
+        while level:
+            requests = [(node_path, self.zk.get_async(node_path), self.zk.get_children_async(node_path))
+                        for node_path in level]
+            level = []
+            for node_path, value_request, children_request in requests:
+                try:
+                    value, _stat = value_request.get()
+                    children = children_request.get()
+                except NoNodeError:
+                    if node_path == path:
+                        raise
+                    # node was deleted while reading
+                    continue
+                nodes[node_path[len(root):] or '/'] = self._unpack_value(node_path, value or '')
+                level.extend(root + node_path[len(root):].rstrip('/') + '/' + child for child in self._visible_children(children))
+        return nodes
+
+    def _commit_transaction(self, transaction):
+        """
+        Commit a transaction and raise an error of the failed operation.
+
+        *Returns:*\n
+        List of results of operations.
+        """
+        results = transaction.commit()
+        for operation, result in zip(transaction.operations, results):
+            if isinstance(result, Exception) and not isinstance(result, RolledBackError):
+                raise type(result)('Transaction failed on %s: %s' % (operation, result))
+        return results
+
+    def _is_yaml(self, filename):
+        """
+        Check if a file should be read or written as yaml.
+        """
+        if filename.lower().endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise Exception('PyYAML is required for yaml files: https://pypi.python.org/pypi/PyYAML')
+            return True
+        return False
@@ -1,24 +1,107 @@
 # -*- coding: utf-8 -*-
 
 from robot.libraries.BuiltIn import BuiltIn
+from robot.api import logger
 from SSHLibrary import SSHLibrary
 from AdvancedLogging import AdvancedLogging
 import zipfile
+import csv
+import itertools
+import pipes
+import Queue
 import os
-import shutil
-import string
+import threading
+import time
+import zlib
+
+# shell-функция для вырезания новой части лога в stdout: cut_log <лог> <смещение> <inode>
+# если inode изменился или лог стал меньше смещения, лог ротирован или усечен и вырезается с начала
+CUT_LOG_FUNCTION = '''cut_log() {
+    set -- "$1" "$2" "$3" $(stat -c '%s %i' "$1" 2>/dev/null)
+    offset=$2
+    if [ -z "$4" ] || [ "$5" != "$3" ] || [ "$4" -lt "$offset" ]; then offset=0; fi
+    if [ -n "$4" ] && [ "$4" -gt "$offset" ]; then
+        tail -c +$((offset + 1)) "$1" | head -c $(($4 - offset))
+    fi
+}'''
+
+# shell-функция для вырезания зафиксированного диапазона лога в stdout: cut_range <лог> <начало> <конец> <inode>
+# если лог уже ротирован, файл ищется по inode в том же каталоге
+CUT_RANGE_FUNCTION = '''cut_range() {
+    f=$1
+    if [ "$(stat -c %i "$f" 2>/dev/null)" != "$4" ]; then
+        f=$(find "$(dirname "$1")" -maxdepth 1 -inum "$4" -print -quit 2>/dev/null)
+    fi
+    if [ -n "$f" ]; then
+        tail -c +$(($2 + 1)) "$f" | head -c $(($3 - $2))
+    fi
+}'''
+
+# awk-фильтр строк по времени: оставляет строки, префикс которых (длиной since) лежит в [since, until];
+# строки без метки времени (например, stack trace) следуют решению для предыдущей строки
+TIME_WINDOW_FILTER = '''BEGIN { n = length(since); shape = since; gsub(/[0-9]/, "0", shape); keep = 1 }
+{ prefix = substr($0, 1, n); s = prefix; gsub(/[0-9]/, "0", s); if (s == shape) keep = (prefix >= since && prefix <= until) }
+keep'''
+
+# awk-фильтр ограничения размера: оставляет первые max/2 и последние max/2 байт целыми строками
+MAX_BYTES_FILTER = '''BEGIN { head = int(max / 2); tail = max - head; first = 0; last = 0 }
+{ len = length($0) + 1; total += len }
+!cut && printed + len <= head { print; printed += len; next }
+{ cut = 1; buf[last++] = $0; kept += len
+  while (kept > tail) { kept -= length(buf[first]) + 1; delete buf[first]; first++ } }
+END { if (total > printed + kept) print "... " (total - printed - kept) " bytes skipped by LogGrabber ..."
+      for (i = first; i < last; i++) print buf[i] }'''
+
+# потоки, сообщения из которых robot записывает в лог; сообщения остальных потоков откладываются
+ROBOT_LOG_THREADS = ("MainThread", "RobotFrameworkTimeoutThread")
+
+# интервал keepalive для ssh-соединений в секундах
+SSH_KEEPALIVE_INTERVAL = 30
+
+# общий для процесса пул ssh-соединений: (hostname, port, username) -> (alias, SSHLibrary)
+_SSH_POOL = dict()
+_SSH_POOL_LOCK = threading.Lock()
+# блокировки переподключения: alias -> Lock; соединение используется и фоновым скачиванием
+_SSH_CONNECT_LOCKS = dict()
+_SSH_ALIAS_COUNTER = itertools.count(1)
+
+# время изменения каталога; пустая строка, если каталога нет
+DIR_MTIME_COMMAND = "find {} -maxdepth 0 -printf '%T@' 2>/dev/null"
+
+# необязательные настройки лога, которые переносятся в подготовленные логи
+LOG_FILTER_KEYS = ("include", "exclude", "max_bytes", "time_format", "time_margin")
+
+# размер блока чтения потока логов
+STREAM_CHUNK_SIZE = 65536
 
 class LogGrabber(object):
     """
     Получение логов подсистем с удаленных серверов. \n
     Принцип работы:
-    - перед началом теста происходит подсчет количества строк в логах
-    - после окончания теста, если количество строк изменилось, то будут скачены только добавленные в лог строки.
+    - перед началом теста запоминается размер (в байтах) и inode каждого лога
+    - после окончания теста, если размер лога увеличился, то будет скачена только дописанная в лог часть;
+      если лог был ротирован (изменился inode) или усечен (размер уменьшился), то будет скачен текущий лог целиком.
+    Для каждого сервера и подготовка, и скачивание логов выполняются одной ssh-командой.
+    Новые части логов сжимаются gzip на удаленном сервере и передаются потоком через stdout
+    прямо в итоговый zip-архив, без временных файлов на удаленном сервере и локально.
+    Сервера обрабатываются параллельно, каждый в своем потоке и со своим ssh-соединением.
+    Если сервер не уложился в timeout, он пропускается с предупреждением
+    и не используется, пока его поток не завершится.
+    Список файлов, удовлетворяющих log_name, кешируется в пределах suite и обновляется
+    только при изменении времени модификации каталога лога. Логи, созданные во время теста,
+    скачиваются с начала.
+    Ssh-соединения хранятся в общем для процесса пуле (по hostname, port и username)
+    и переиспользуются всеми suite; соединение поддерживается keepalive
+    и переоткрывается, если оно было разорвано.
     Для работы библиотеки необходимо
     cоздать переменную server_logs в python [http://robotframework.org/robotframework/latest/RobotFrameworkUserGuide.html#creating-variables-directly|variable file]
     следующего вида:
     | server_logs = {
-    |                 "tmpdir": "/tmp/",
+    |                 "timeout": 60,
+    |                 "background": True,
+    |                 "report": "log_grabber_report.csv",
+    |                 "warn_bytes": 104857600,
+    |                 "warn_seconds": 30,
     |                 "servers": [
     |                   {
     |                     "hostname": "server.com",
@@ -35,7 +118,12 @@ class LogGrabber(object):
     |                           },
     |                           {
     |                             "path_to_log": "/var/log",
-    |                             "log_name": "error*.log"
+    |                             "log_name": "error*.log",
+    |                             "include": "ERROR|WARN",
+    |                             "exclude": "healthcheck",
+    |                             "max_bytes": 10485760,
+    |                             "time_format": "%Y-%m-%d %H:%M:%S",
+    |                             "time_margin": 5
     |                           }
     |                         ]
     |                       }
@@ -44,13 +132,28 @@ class LogGrabber(object):
     |                 ]
     |               }
     Где:
-    - tmpdir - каталог для временных файлов на удаленном сервере
+    - timeout - необязательный, максимальное время в секундах на обработку одного сервера, по умолчанию 60
+    - background - необязательный, при True listener после упавшего теста только фиксирует границы новых частей логов,
+      а вырезание и скачивание выполняются в фоновом потоке; по умолчанию False
+    - report - необязательный, имя csv-файла с метриками сбора логов, записываемого по окончании запуска;
+      относительный путь отсчитывается от ${OUTPUT_DIR}, по умолчанию log_grabber_report.csv;
+      рядом записывается сводка по серверам и фазам с суффиксом _summary (log_grabber_report_summary.csv)
+    - warn_bytes\warn_seconds - необязательные пороги: предупреждение выводится, если новая часть одного лога
+      больше warn_bytes байт или ее получение заняло больше warn_seconds секунд
     - hostname - имя хоста удаленного сервера
     - port - порт подключения по ssh
-    - username\password - логин\пароль для подключения по ssh
+    - username\password - логин\пароль для подключения по ssh;
+      несколько настроек с одинаковыми hostname, port и username обрабатываются как один сервер
     - name - имя подсистемы, для которой собираются логи, должно быть уникальным
     - path_to_log - путь к логам подсистемы
     - log_name - имя файла лога; могут использоваться wildcards аналогичные тем, что применяются в linux-команде find.
+    Необязательные фильтры лога, применяются на удаленном сервере до сжатия:
+    - include\exclude - регулярное выражение (grep -E) для строк, которые нужно оставить\исключить
+    - max_bytes - максимальный размер части лога в байтах; при превышении сохраняются начало и конец части
+    - time_format - формат метки времени в начале строки лога (date +FORMAT); если задан, сохраняются
+      только строки, записанные между началом и окончанием теста по часам сервера.
+      Формат должен быть числовым и упорядоченным от года к секундам, например %Y-%m-%d %H:%M:%S
+    - time_margin - запас в секундах для time_format до начала и после окончания теста, по умолчанию 0
 
     === Ограничения ===
     Логи подсистем должны находится на Linux сервере с возможностью подключения к нему по ssh.
@@ -59,6 +162,9 @@ class LogGrabber(object):
     1. В качестве [http://robotframework.org/robotframework/latest/RobotFrameworkUserGuide.html#using-listener-interface|listener]:\n
     ``pybot --listener LogGrabber /path/to/test_suite``\n
     При этом нет необходимости изменять тесты. 
+    Соединение с каждым сервером открывается один раз за запуск и закрывается после его окончания.
+    Если задан background, тест не ждет скачивания логов: архив скачивается в фоне
+    в директорию упавшего теста, а по окончании запуска listener ожидает завершения всех скачиваний.
     После завершения теста со статусом FAILED будет скачена лишь та часть логов, которая была записана во время его проходжения.
     
     2. В качестве библиотеки:\n
@@ -100,24 +206,50 @@ class LogGrabber(object):
     def __init__(self):
         # загрузка встроенных библиотек
         self.bi=BuiltIn()
-        self.ssh=SSHLibrary()
         self.adv_log=AdvancedLogging()
  
         # словарь с подготовленными логами
         self.prepared_logs = dict()
+        # экземпляры SSHLibrary из пула для серверов текущей настройки: alias -> SSHLibrary
+        self._clients = dict()
+        # alias серверов, потоки которых еще не завершились
+        self._busy = set()
+        self._busy_lock = threading.Lock()
+        # кеш списков файлов логов: (alias, path_to_log, log_name) -> (время изменения каталога, имена файлов)
+        self._glob_cache = dict()
+        # очередь фонового скачивания логов и ее поток
+        self._download_queue = Queue.Queue()
+        self._download_thread = None
+        # предупреждения из фоновых потоков, ожидающие вывода из основного потока
+        self._pending_warnings = []
+        self._pending_warnings_lock = threading.Lock()
+        # метрики сбора логов: (timestamp, hostname, phase, log, bytes, compressed_bytes, seconds)
+        self._metric_samples = []
+        self._metric_samples_lock = threading.Lock()
 
     def start_suite(self, name, attrs):
+        self._flush_warnings()
         self.set_connections()
 
     def start_test(self, name, attrs):
+        self._flush_warnings()
         self.prepare_logs()
 
     def end_test(self, name, attrs):
+        self._flush_warnings()
         if attrs['status'] != 'PASS':
-            self.download_logs()
+            if self.logs.get("background"):
+                self.capture_logs()
+            else:
+                self.download_logs()
 
-    def end_suite(self, name, attrs):
+    def close(self):
         self.close_connections()
+        if self._metric_samples:
+            # вывод robot уже закрыт, поэтому метрики только записываются в файлы
+            with self._metric_samples_lock:
+                samples = list(self._metric_samples)
+            self._write_metrics(self.logs.get("report", "log_grabber_report.csv"), samples, self._summarize_metrics(samples))
 
     def set_connections(self):
         """
@@ -130,148 +262,667 @@ class LogGrabber(object):
         self.sys_separator=self.bi.get_variable_value('${/}')
         # Разделитель в unix
         self.nix_separator = '/'
+        # Каталог для отчета с метриками; по окончании запуска переменные robot недоступны
+        self.output_dir = self.bi.get_variable_value('${OUTPUT_DIR}')
+        # Максимальное время обработки одного сервера
+        self.timeout = float(self.logs.get("timeout", 60))
+        # списки файлов логов кешируются в пределах suite
+        self._glob_cache.clear()
+
+        # для каждого сервера берем ssh-соединение из пула,
+        # которое будет жить в течение всего запуска
+        # настройки с одинаковыми hostname, port и username объединяются в один сервер
+        # с общим списком подсистем, так как используют одно соединение
+        self.servers = []
+        merged_servers = dict()
+        for server in self.logs["servers"]:
+            key = (server["hostname"], server["port"], server["username"])
+            if key in merged_servers:
+                merged_servers[key]["subsystems"].extend(server["subsystems"])
+                continue
+            with _SSH_POOL_LOCK:
+                if key not in _SSH_POOL:
+                    ssh_alias = "{}@{}:{}#{}".format(server["username"], server["hostname"], server["port"], next(_SSH_ALIAS_COUNTER))
+                    _SSH_POOL[key] = (ssh_alias, SSHLibrary())
+                    _SSH_CONNECT_LOCKS[ssh_alias] = threading.Lock()
+                ssh_alias, ssh = _SSH_POOL[key]
+            self._clients[ssh_alias] = ssh
+            merged_server = dict(server, ssh_alias=ssh_alias, subsystems=list(server["subsystems"]))
+            merged_servers[key] = merged_server
+            self.servers.append(merged_server)
+        self._run_on_servers(self._connect, self.servers)
 
-        # перебираем сервера из словаря настройки
-        # для каждого сервера создаем одтельное ssh-соединение,
-        # которое будет жить в течение всего suite
-        # дописываем alias в словарь для каждого сервера
-        for _, server in enumerate(self.logs["servers"]):
-            hostname = server["hostname"]
-            port = server["port"]
-            username = server["username"]
-            password = server["password"]
-            ssh_alias = str(self.bi.get_time('epoch'))
-            # создаем ssh-соединение - alias = epoch timestamp
-            self.ssh.open_connection(hostname, ssh_alias, port)
-            self.ssh.login(username, password)
-            server["ssh_alias"] = ssh_alias
+    def _connect(self, server, _=None):
+        """
+        Получение ssh-соединения с сервером из пула.
+        Если соединение еще не открыто или разорвано, оно открывается заново.
+
+        *Args:*\n
+        _server_ - настройка сервера
+
+        *Returns:*\n
+        Экземпляр SSHLibrary, подключенный к серверу.
+        """
+        ssh = self._clients[server["ssh_alias"]]
+        with _SSH_CONNECT_LOCKS[server["ssh_alias"]]:
+            try:
+                if ssh.current.client.get_transport().is_active():
+                    return ssh
+            except Exception:
+                pass
+            ssh.close_all_connections()
+            ssh.open_connection(server["hostname"], server["ssh_alias"], server["port"])
+            ssh.login(server["username"], server["password"])
+            ssh.current.client.get_transport().set_keepalive(SSH_KEEPALIVE_INTERVAL)
+        return ssh
+
+    def _run_on_servers(self, func, servers, group="foreground"):
+        """
+        Параллельный вызов func(server, server_index) для каждого сервера в отдельном потоке.
+
+        *Args:*\n
+        _func_ - функция обработки сервера
+        _servers_ - список серверов
+        _group_ - группа операций; сервер пропускается, пока не завершился его поток из той же группы
+
+        *Returns:*\n
+        Список результатов в порядке серверов; None для сервера, завершившегося с ошибкой или по timeout.
+        """
+        results = dict()
+        # ошибки потоков выводятся здесь: сообщения robot из рабочих потоков теряются
+        errors = dict()
+        threads = []
+        for index, server in enumerate(servers):
+            busy_key = (group, server["ssh_alias"])
+            with self._busy_lock:
+                if busy_key in self._busy:
+                    self._warn("LogGrabber: server {} is still busy, skipped".format(server["hostname"]))
+                    continue
+                self._busy.add(busy_key)
+            thread = threading.Thread(target=self._server_worker, args=(func, server, index, results, errors, busy_key))
+            thread.daemon = True
+            thread.start()
+            threads.append((server, thread))
+        # все потоки запущены одновременно, поэтому timeout отсчитывается от общего момента
+        deadline = time.time() + self.timeout
+        for server, thread in threads:
+            thread.join(max(0, deadline - time.time()))
+            if thread.is_alive():
+                self._warn("LogGrabber: server {} did not respond in {} seconds".format(server["hostname"], self.timeout))
+        for index, error in sorted(errors.items()):
+            self._warn("LogGrabber: server {} failed: {}".format(servers[index]["hostname"], error))
+        return [results.get(index) for index in range(len(servers))]
+
+    def _warn(self, message):
+        """
+        Вывод предупреждения. Robot записывает в лог только сообщения из основного потока,
+        поэтому предупреждения из фоновых потоков откладываются до вызова _flush_warnings.
+        """
+        if threading.current_thread().name in ROBOT_LOG_THREADS:
+            logger.warn(message)
+        else:
+            with self._pending_warnings_lock:
+                self._pending_warnings.append(message)
+
+    def _flush_warnings(self):
+        """
+        Вывод предупреждений, отложенных фоновыми потоками.
+        """
+        with self._pending_warnings_lock:
+            warnings = self._pending_warnings
+            self._pending_warnings = []
+        for message in warnings:
+            logger.warn(message)
+
+    def _server_worker(self, func, server, index, results, errors, busy_key):
+        """
+        Обработка одного сервера в отдельном потоке.
+        Результат или ошибка сохраняются для вызывающего потока.
+        """
+        try:
+            results[index] = func(server, index)
+        except Exception, e:
+            errors[index] = e
+        finally:
+            with self._busy_lock:
+                self._busy.discard(busy_key)
     
     def prepare_logs(self):
         """
         Подготовка логов.
         В результате для каждого лога, удовлетворяющего настройке,
-        записывается номер послнедней строки.
+        записываются его размер в байтах и inode.
+        Для каждого сервера выполняется одна команда, которая находит и измеряет все логи;
+        сервера обрабатываются параллельно.
 
         """
 
         # структура с описанием серверов, подсистем и логов
-        self.prepared_logs["servers"] = []
-        # перебираем сервера из конфигурации
-        for server in self.logs["servers"]:
-            processed_server = dict()
-            hostname = server["hostname"]
-            port = server["port"]
-            username = server["username"]
-            password = server["password"]
-            ssh_alias = server["ssh_alias"]
-            # заполняем словарь, описывающий обработанный сервер
-            processed_server["hostname"] = hostname
-            processed_server["port"] = port
-            processed_server["username"] = username
-            processed_server["password"] = password
-            processed_server["ssh_alias"] = ssh_alias
-            processed_server["subsystems"] = []
-            # переключаемся на соединение с alias = ssh_alias из словаря настройки
-            self.ssh.switch_connection(ssh_alias)
-            # для каждого сервера обрабатываем набор подсистем
-            for subsystem in server["subsystems"]:
-                # словарь обработанных подсистем
-                processed_subsys = dict()
-                processed_subsys["name"] = subsystem["name"]
-                # список обработанных логов
-                processed_logs = []
-                # обрабатываем логи для текущей подсистемы
-                for subsys_log in subsystem["logs"]:
-                    path_to_log = subsys_log["path_to_log"]
-                    log_name_regexp = subsys_log["log_name"]
-                    # получаем список лог-файлов по regexp
-                    log_name_list_text = self.ssh.execute_command("find {}{}{} -printf '%f\n'".format(path_to_log, self.nix_separator, log_name_regexp), True, True, True)
-                    # если список не пуст и код возврата команды 0 (success)
-                    if ((len(log_name_list_text[0]) > 0) & (log_name_list_text[2] == 0) ):
-                        # формируем массив имен лог-файлов
-                        log_name_array = string.split(log_name_list_text[0], '\n')
-                        # для каждого файла получаем номер последней строки
-                        for log_name in log_name_array:
-                            line_number = self.ssh.execute_command("cat {}{}{}  | wc -l".format(path_to_log, self.nix_separator, log_name))
-                            processed_logs.append({"path_to_log": path_to_log, "log_name": log_name, "line_number": line_number})
-                # проверка для исключения "мусора" processed_subsys
-                if (len(processed_logs)>0):
-                    processed_subsys["logs"] = processed_logs
-                    processed_server["subsystems"].append(processed_subsys)
-            # проверка - есть ли для сервера обработанные подсистемы с логами
-            if (len(processed_server["subsystems"])>0):
-                self.prepared_logs["servers"].append(processed_server)
-    
+        # сервер, не подготовленный из-за ошибки или timeout, пропускается
+        processed_servers = self._run_on_servers(self._prepare_server, self.servers)
+        self.prepared_logs["servers"] = [server for server in processed_servers if server]
+
+    def _prepare_server(self, server, _):
+        """
+        Подготовка логов одного сервера.
+
+        *Args:*\n
+        _server_ - настройка сервера из server_logs
+
+        *Returns:*\n
+        Словарь, описывающий обработанный сервер.
+        """
+        processed_server = dict()
+        # заполняем словарь, описывающий обработанный сервер
+        for key in ("hostname", "port", "username", "password", "ssh_alias"):
+            processed_server[key] = server[key]
+        processed_server["subsystems"] = []
+        ssh = self._connect(server)
+        # список настроек логов сервера в порядке их обработки скриптом
+        log_settings = [(subsystem, subsys_log) for subsystem in server["subsystems"] for subsys_log in subsystem["logs"]]
+        local_time = int(time.time())
+        server_time, measured_logs, mtimes = self._measure_logs(ssh, server, log_settings)
+        # время начала и расхождение часов сервера с локальными - для фильтра по времени
+        processed_server["start_time"] = server_time
+        processed_server["clock_skew"] = server_time - local_time
+        # настройки логов с найденными файлами - для поиска логов, созданных во время теста
+        processed_server["globs"] = []
+        for index, (subsystem, subsys_log) in enumerate(log_settings):
+            glob = {"subsystem": subsystem["name"], "path_to_log": subsys_log["path_to_log"], "log_name": subsys_log["log_name"],
+                    "mtime": mtimes[index], "known": [log_name for log_name, _, _ in measured_logs[index]]}
+            for key in LOG_FILTER_KEYS:
+                if key in subsys_log:
+                    glob[key] = subsys_log[key]
+            processed_server["globs"].append(glob)
+        # для каждого сервера обрабатываем набор подсистем
+        for subsystem in server["subsystems"]:
+            # словарь обработанных подсистем
+            processed_subsys = dict()
+            processed_subsys["name"] = subsystem["name"]
+            # список обработанных логов
+            processed_logs = []
+            # обрабатываем логи для текущей подсистемы
+            for index, (log_subsystem, subsys_log) in enumerate(log_settings):
+                if log_subsystem is not subsystem:
+                    continue
+                for log_name, size, inode in measured_logs[index]:
+                    processed_log = {"path_to_log": subsys_log["path_to_log"], "log_name": log_name, "offset": size, "inode": inode}
+                    for key in LOG_FILTER_KEYS:
+                        if key in subsys_log:
+                            processed_log[key] = subsys_log[key]
+                    processed_logs.append(processed_log)
+            # проверка для исключения "мусора" processed_subsys
+            if (len(processed_logs)>0):
+                processed_subsys["logs"] = processed_logs
+                processed_server["subsystems"].append(processed_subsys)
+        # сервер сохраняется и без найденных логов: они могут появиться во время теста
+        return processed_server
+
+    def _measure_logs(self, ssh, server, log_settings):
+        """
+        Поиск и измерение логов на сервере одной командой.
+        Если каталог лога не изменился с предыдущего поиска, измеряются закешированные файлы,
+        иначе выполняется поиск по log_name.
+
+        *Args:*\n
+        _ssh_ - экземпляр SSHLibrary, подключенный к серверу
+        _server_ - настройка сервера
+        _log_settings_ - список пар (подсистема, настройка лога)
+
+        *Returns:*\n
+        Время сервера (epoch);
+        список, в котором для каждой настройки лога содержится список кортежей (имя файла, размер, inode);
+        список времен изменения каталогов логов, None - если время нельзя использовать для проверки.
+        """
+        ssh_alias = server["ssh_alias"]
+        # выводим время сервера, а для каждой настройки - маркер с временем изменения каталога
+        # и имена, размеры и inode найденных файлов
+        script = ["echo \"@$(date +%s)\""]
+        for index, (_, subsys_log) in enumerate(log_settings):
+            path = pipes.quote(subsys_log["path_to_log"])
+            find = "find {}{}{} -maxdepth 0 -type f -printf '%f\\t%s\\t%i\\n' 2>/dev/null".format(
+                path, self.nix_separator, subsys_log["log_name"])
+            script.append("m=$({}); echo \"#{}\t$m\"".format(DIR_MTIME_COMMAND.format(path), index))
+            cached = self._glob_cache.get((ssh_alias, subsys_log["path_to_log"], subsys_log["log_name"]))
+            if cached is None:
+                script.append(find)
+            elif cached[1]:
+                script.append("if [ \"$m\" = {} ]; then (cd {} && stat --printf '%n\\t%s\\t%i\\n' -- {}) 2>/dev/null; else {}; fi".format(
+                    pipes.quote(cached[0]), path, " ".join(pipes.quote(log_name) for log_name in cached[1]), find))
+            else:
+                script.append("if [ \"$m\" != {} ]; then {}; fi".format(pipes.quote(cached[0]), find))
+        started = time.time()
+        stdout = ssh.execute_command("\n".join(script))
+        self._record_metric(server["hostname"], "measure", "", None, None, time.time() - started)
+        measured_logs = [[] for _ in log_settings]
+        mtimes = [None for _ in log_settings]
+        server_time = None
+        index = None
+        for line in stdout.splitlines():
+            if line.startswith('@'):
+                server_time = int(line[1:])
+            elif line.startswith('#'):
+                index, mtime = line[1:].split('\t')
+                index = int(index)
+                # время изменения в пределах последней секунды не гарантирует,
+                # что после поиска в каталоге не появились новые файлы
+                if mtime and float(mtime) < server_time - 1:
+                    mtimes[index] = mtime
+            elif line and index is not None:
+                log_name, size, inode = line.split('\t')
+                measured_logs[index].append((log_name, int(size), inode))
+        for index, (_, subsys_log) in enumerate(log_settings):
+            key = (ssh_alias, subsys_log["path_to_log"], subsys_log["log_name"])
+            if mtimes[index] is None:
+                self._glob_cache.pop(key, None)
+            else:
+                self._glob_cache[key] = (mtimes[index], [log_name for log_name, _, _ in measured_logs[index]])
+        return server_time, measured_logs, mtimes
+
     def download_logs(self):
         """
         Формирование и загрузка логов.
         В результате в директории теста, созданной AdvancedLogging,
-        получаем архив с логами [TIMESTAMP]_logs.zip
+        получаем архив с логами [TIMESTAMP]_logs.zip,
+        в котором новая часть каждого лога лежит в файле <подсистема>/[TIMESTAMP]_<имя_лога>.gz
+        Логи, созданные после подготовки, скачиваются целиком.
+        Для каждого сервера выполняется одна команда, которая выводит сжатые новые части всех логов в stdout;
+        поток записывается в zip-архив по мере получения, сервера обрабатываются параллельно.
 
         """
         timestamp = self.bi.get_time('epoch')
+        end_time = int(time.time())
         # базовая директория теста
-        base_dir = self.adv_log.Create_Advanced_Logdir()
+        base_dir = self.adv_log.create_advanced_logdir()
         # имя результирующего архива с логами
-        res_arc_name = os.path.join(base_dir, "{}_logs".format(timestamp))
-        # результирующая директория для логов
-        logs_dir = os.path.join(base_dir, "logs")
-        # временная директория на целевом сервере
-        temp_dir = self.logs['tmpdir']
-        # обрабатыаем сервера, с подготовленными логами
-        for server in self.prepared_logs["servers"]:
-            # параметры подключения к серверу
-            ssh_alias = server["ssh_alias"]
-            # переключаемся на соединение с alias = ssh_alias из словаря
-            self.ssh.switch_connection(ssh_alias)
-            # обрабатываем подсистемы с подготовленными логами
-            for subsystem in server["subsystems"]:
-                # структура в которую скачиваются логи [Advanced_Logdir]/logs/<подсистема>/
-                subsys_dir = os.path.join(logs_dir, subsystem["name"])
-                for log in subsystem["logs"]:
-                    abs_log_name = "{}{}{}".format(log["path_to_log"], self.nix_separator, log["log_name"])
-                    # имя файла содержащего интересующую нас часть, лога
-                    cut_log_name = "{}_{}".format(timestamp, log["log_name"])
-                    # абсолютный пусть с именем файла (cut_[имя_лога]) - для интересующего нас куска лога
-                    cut_abs_log_name = "{}{}{}".format(temp_dir, self.nix_separator, cut_log_name)
-                    # текущий номер строки в логе
-                    cur_line_number = self.ssh.execute_command("cat {} | wc -l".format(abs_log_name))
-                    # проверяем, появились ли строки в логе с момента подготовки логов
-                    if (cur_line_number > log["line_number"]):
-                        # вырезаем часть лога, начиная с сохраненного номера строки
-                        self.ssh.execute_command("tail -n +{} {} > {}".format(log["line_number"], abs_log_name, cut_abs_log_name))
-                        # gzip
-                        self.ssh.execute_command("gzip {}.gz {}".format(cut_abs_log_name, cut_abs_log_name))
-                        # скачиваем файл
-                        self.ssh.get_file("{}.gz".format(cut_abs_log_name), "{}{}{}.gz".format(subsys_dir, self.sys_separator, cut_log_name))
-                        # удаляем вырезанную чыасть лога и gz-архив этой части
-                        self.ssh.execute_command("rm {}".format(cut_abs_log_name))
-                        self.ssh.execute_command("rm {}.gz".format(cut_abs_log_name ))
-        # если есть результат - упаковываем в единый zip-архив и удаляем папку с логами
-        if (os.path.exists(logs_dir)):
-            self._zip(logs_dir, res_arc_name)
-            shutil.rmtree(logs_dir)
+        res_arc_name = os.path.join(base_dir, "{}_logs.zip".format(timestamp))
+        self._write_archive(res_arc_name, self.prepared_logs["servers"],
+                            lambda server, add_entry: self._download_server(server, timestamp, end_time, add_entry))
+        # предупреждения о превышении порогов сохранены потоками серверов
+        self._flush_warnings()
 
-    def close_connections(self):
+    def capture_logs(self):
         """
-        Закрытие ssh-соединений с удаленными серверами
+        Фиксация новых частей логов и их фоновое скачивание.
+        Сразу измеряются только текущие размеры и inode логов; вырезание, сжатие и скачивание
+        выполняются в фоновом потоке в архив [TIMESTAMP]_logs.zip в директории текущего теста.
+        Дождаться завершения фоновых скачиваний можно с помощью `Close connections`.
+
         """
-        self.ssh.close_all_connections()
-    
-    def _zip(self, src, dst):
+        timestamp = self.bi.get_time('epoch')
+        end_time = int(time.time())
+        # директория теста определяется сейчас, пока AdvancedLogging указывает на текущий тест
+        base_dir = self.adv_log.create_advanced_logdir()
+        res_arc_name = os.path.join(base_dir, "{}_logs.zip".format(timestamp))
+        captured_servers = self._run_on_servers(self._capture_server, self.prepared_logs["servers"])
+        captured_servers = [server for server in captured_servers if server]
+        if not captured_servers:
+            return
+        if self._download_thread is None:
+            self._download_thread = threading.Thread(target=self._download_worker)
+            self._download_thread.daemon = True
+            self._download_thread.start()
+        self._download_queue.put((res_arc_name, captured_servers, timestamp, end_time))
+
+    def _capture_server(self, server, _):
         """
-         Упаковка логов единый zip-архив
+        Фиксация границ новых частей логов одного сервера.
 
         *Args:*\n
-        _src_ - директория для упаковки
-        _dst_ - имя лога
-
-        """
-        zf = zipfile.ZipFile("%s.zip" % (dst), "w", zipfile.ZIP_DEFLATED)
-        abs_src = os.path.abspath(src)
-        for root, _, files in os.walk(src):
-            for filename in files:
-                abs_name = os.path.abspath(os.path.join(root, filename))
-                arc_name = abs_name[len(abs_src) + 1:]
-                zf.write(abs_name, arc_name)
-        zf.close()
\ No newline at end of file
+        _server_ - подготовленный сервер из prepared_logs
+
+        *Returns:*\n
+        Словарь с параметрами сервера и списком логов с диапазонами для скачивания
+        или None, если новых данных нет.
+        """
+        # подготовленные смещения: (подсистема, каталог, имя) -> (смещение, inode)
+        prepared = dict()
+        for subsystem in server["subsystems"]:
+            for log in subsystem["logs"]:
+                prepared[(subsystem["name"], log["path_to_log"], log["log_name"])] = (log["offset"], log["inode"])
+        # измеряем все логи, удовлетворяющие настройкам, в том числе созданные во время теста
+        log_settings = [(None, glob) for glob in server["globs"]]
+        _, measured_logs, _ = self._measure_logs(self._connect(server), server, log_settings)
+        captured_server = dict()
+        for key in ("hostname", "port", "username", "password", "ssh_alias", "start_time", "clock_skew"):
+            captured_server[key] = server[key]
+        captured_server["logs"] = []
+        for index, glob in enumerate(server["globs"]):
+            for log_name, size, inode in measured_logs[index]:
+                offset, prepared_inode = prepared.get((glob["subsystem"], glob["path_to_log"], log_name), (0, None))
+                # ротированный или усеченный лог скачивается с начала
+                if prepared_inode != inode or size < offset:
+                    offset = 0
+                if size == offset:
+                    continue
+                captured_log = {"subsystem": glob["subsystem"], "path_to_log": glob["path_to_log"], "log_name": log_name,
+                                "offset": offset, "end": size, "inode": inode}
+                for key in LOG_FILTER_KEYS:
+                    if key in glob:
+                        captured_log[key] = glob[key]
+                captured_server["logs"].append(captured_log)
+        if captured_server["logs"]:
+            return captured_server
+        return None
+
+    def _download_worker(self):
+        """
+        Фоновый поток скачивания зафиксированных логов; завершается, получив из очереди None.
+        """
+        while True:
+            job = self._download_queue.get()
+            if job is None:
+                self._download_queue.task_done()
+                return
+            res_arc_name, captured_servers, timestamp, end_time = job
+            try:
+                self._write_archive(res_arc_name, captured_servers,
+                                    lambda server, add_entry: self._download_captured_server(server, timestamp, end_time, add_entry),
+                                    "background")
+            except Exception, e:
+                self._warn("LogGrabber: background download to {} failed: {}".format(res_arc_name, e))
+            finally:
+                self._download_queue.task_done()
+
+    def _download_captured_server(self, server, timestamp, end_time, add_entry):
+        """
+        Вырезание зафиксированных частей логов одного сервера и их запись в архив.
+
+        *Args:*\n
+        _server_ - сервер, возвращенный _capture_server
+        _timestamp_ - метка времени фиксации
+        _end_time_ - локальное время окончания теста (epoch)
+        _add_entry_ - функция записи файла в архив: add_entry(имя, сжатые данные)
+        """
+        script = [CUT_RANGE_FUNCTION]
+        server_end_time = end_time + server["clock_skew"]
+        for log in server["logs"]:
+            abs_log_name = "{}{}{}".format(log["path_to_log"], self.nix_separator, log["log_name"])
+            script.append("printf '%s' {} | gzip -c".format(pipes.quote("{}/{}_{}.gz".format(log["subsystem"], timestamp, log["log_name"]))))
+            pipeline = ["cut_range {} {} {} {}".format(pipes.quote(abs_log_name), log["offset"], log["end"], pipes.quote(str(log["inode"])))]
+            pipeline.extend(self._log_filters(log, server["start_time"], server_end_time))
+            pipeline.append("gzip -c")
+            script.append(" | ".join(pipeline))
+        self._stream_logs(self._connect(server), server, "\n".join(script), add_entry)
+
+    def _write_archive(self, res_arc_name, servers, download, group="foreground"):
+        """
+        Параллельное скачивание логов серверов в один zip-архив.
+
+        *Args:*\n
+        _res_arc_name_ - имя zip-архива
+        _servers_ - список серверов
+        _download_ - функция скачивания логов сервера: download(server, add_entry)
+        _group_ - группа операций для _run_on_servers
+        """
+        # архив создается при получении первого непустого лога;
+        # после завершения скачивания запись от опоздавших потоков игнорируется
+        lock = threading.Lock()
+        archive = {"zip": None, "closed": False}
+
+        def add_entry(arc_name, data):
+            with lock:
+                if archive["closed"]:
+                    return
+                if archive["zip"] is None:
+                    archive["zip"] = zipfile.ZipFile(res_arc_name, "w", zipfile.ZIP_STORED)
+                archive["zip"].writestr(arc_name, data)
+
+        self._run_on_servers(lambda server, _: download(server, add_entry), servers, group)
+        with lock:
+            archive["closed"] = True
+            if archive["zip"] is not None:
+                archive["zip"].close()
+
+    def _download_server(self, server, timestamp, end_time, add_entry):
+        """
+        Вырезание новых частей логов одного сервера и их запись в архив.
+
+        *Args:*\n
+        _server_ - подготовленный сервер из prepared_logs
+        _timestamp_ - метка времени, общая для всех серверов
+        _end_time_ - локальное время окончания теста (epoch)
+        _add_entry_ - функция записи файла в архив: add_entry(имя, сжатые данные)
+        """
+        script = [CUT_LOG_FUNCTION]
+        # окончание теста по часам сервера
+        server_end_time = end_time + server["clock_skew"]
+        # каждый лог выводится двумя gzip-member: заголовок с именем файла в архиве
+        # <подсистема>/<timestamp>_<имя_лога>.gz и часть лога; пустая часть - пустым gzip-member
+        for subsystem in server["subsystems"]:
+            for log in subsystem["logs"]:
+                abs_log_name = "{}{}{}".format(log["path_to_log"], self.nix_separator, log["log_name"])
+                script.append("printf '%s' {} | gzip -c".format(pipes.quote("{}/{}_{}.gz".format(subsystem["name"], timestamp, log["log_name"]))))
+                pipeline = ["cut_log {} {} {}".format(pipes.quote(abs_log_name), log["offset"], pipes.quote(str(log["inode"])))]
+                pipeline.extend(self._log_filters(log, server["start_time"], server_end_time))
+                pipeline.append("gzip -c")
+                script.append(" | ".join(pipeline))
+        # логи, созданные после подготовки, ищутся только в изменившихся каталогах
+        for glob in server["globs"]:
+            path = pipes.quote(glob["path_to_log"])
+            loop = ["for f in {}{}{}; do".format(path, self.nix_separator, glob["log_name"]),
+                    "[ -f \"$f\" ] || continue"]
+            if glob["known"]:
+                loop.append("case \"${{f##*/}}\" in {}) continue ;; esac".format("|".join(pipes.quote(log_name) for log_name in glob["known"])))
+            loop.append("printf '%s' {}\"${{f##*/}}\".gz | gzip -c".format(pipes.quote("{}/{}_".format(glob["subsystem"], timestamp))))
+            loop.append(" | ".join(["cut_log \"$f\" 0 ''"] + self._log_filters(glob, server["start_time"], server_end_time) + ["gzip -c"]))
+            loop.append("done")
+            if glob["mtime"] is None:
+                script.extend(loop)
+            else:
+                script.append("if [ \"$({})\" != {} ]; then".format(DIR_MTIME_COMMAND.format(path), pipes.quote(glob["mtime"])))
+                script.extend(loop)
+                script.append("fi")
+        self._stream_logs(self._connect(server), server, "\n".join(script), add_entry)
+
+    def _log_filters(self, log, start_time, end_time):
+        """
+        Команды фильтрации части лога согласно его настройкам.
+
+        *Args:*\n
+        _log_ - подготовленный лог
+        _start_time_ - время начала теста по часам сервера (epoch)
+        _end_time_ - время окончания теста по часам сервера (epoch)
+
+        *Returns:*\n
+        Список shell-команд для конвейера.
+        """
+        filters = []
+        if log.get("time_format"):
+            margin = int(log.get("time_margin", 0))
+            time_format = pipes.quote("+{}".format(log["time_format"]))
+            filters.append('LC_ALL=C awk -v since="$(date -d @{} {})" -v until="$(date -d @{} {})" {}'.format(
+                start_time - margin, time_format, end_time + margin, time_format, pipes.quote(TIME_WINDOW_FILTER)))
+        if log.get("include"):
+            filters.append("grep -E -e {}".format(pipes.quote(log["include"])))
+        if log.get("exclude"):
+            filters.append("grep -E -v -e {}".format(pipes.quote(log["exclude"])))
+        if log.get("max_bytes"):
+            filters.append("LC_ALL=C awk -v max={} {}".format(int(log["max_bytes"]), pipes.quote(MAX_BYTES_FILTER)))
+        return filters
+
+    def _stream_logs(self, ssh, server, script, add_entry):
+        """
+        Выполнение скрипта и разбор его stdout на последовательные gzip-member:
+        для каждого лога заголовок с именем файла в архиве и часть лога.
+        Граница member определяется по появлению unused_data у распаковщика;
+        сжатые данные каждой непустой части лога записываются в архив без перепаковки.
+
+        *Args:*\n
+        _ssh_ - экземпляр SSHLibrary, подключенный к серверу
+        _server_ - сервер, для метрик
+        _script_ - скрипт, выводящий логи
+        _add_entry_ - функция записи файла в архив
+        """
+        download_started = time.time()
+        _, stdout, stderr = ssh.current.client.exec_command(script)
+        channel = stdout.channel
+        channel.settimeout(self.timeout)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # имя файла текущего лога; None - ожидается заголовок
+        arc_name = None
+        # распакованные данные заголовка или сжатые части лога и размер распакованных данных текущего member
+        member = []
+        size = 0
+        # момент получения заголовка текущего лога
+        started = download_started
+        while True:
+            data = channel.recv(STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            while data:
+                output = decompressor.decompress(data)
+                size += len(output)
+                tail = decompressor.unused_data
+                member.append(output if arc_name is None else data[:len(data) - len(tail)])
+                if not tail:
+                    break
+                # member закончился, остаток относится к следующим
+                arc_name = self._complete_member(server, arc_name, member, size, add_entry, started)
+                started = time.time()
+                member = []
+                size = 0
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data = tail
+        if member:
+            arc_name = self._complete_member(server, arc_name, member, size, add_entry, started)
+        self._record_metric(server["hostname"], "download", "", None, None, time.time() - download_started)
+        if channel.recv_exit_status() != 0 or arc_name is not None:
+            raise RuntimeError("log stream is incomplete: {}".format(stderr.read().strip()))
+
+    def _complete_member(self, server, arc_name, member, size, add_entry, started):
+        """
+        Обработка завершенного gzip-member: запоминание заголовка или запись непустой части лога в архив.
+        Для части лога сохраняются метрики: время получения (вырезание, сжатие и передача выполняются
+        на сервере одним конвейером) и время записи в архив.
+
+        *Returns:*\n
+        Имя файла в архиве, если member был заголовком, иначе None.
+        """
+        if arc_name is None:
+            return "".join(member)
+        if size:
+            stream_seconds = time.time() - started
+            data = "".join(member)
+            zip_started = time.time()
+            add_entry(arc_name, data)
+            zip_seconds = time.time() - zip_started
+            self._record_metric(server["hostname"], "stream", arc_name, size, len(data), stream_seconds)
+            self._record_metric(server["hostname"], "zip", arc_name, None, None, zip_seconds)
+            warn_bytes = self.logs.get("warn_bytes")
+            warn_seconds = self.logs.get("warn_seconds")
+            if (warn_bytes and size > warn_bytes) or (warn_seconds and stream_seconds + zip_seconds > warn_seconds):
+                self._warn("LogGrabber: capture of {} from {} took {:.3f} seconds for {} bytes ({} compressed)".format(
+                    arc_name, server["hostname"], stream_seconds + zip_seconds, size, len(data)))
+        return None
+
+    def _record_metric(self, hostname, phase, log_name, size, compressed_size, seconds):
+        """
+        Сохранение метрики сбора логов.
+        """
+        sample = (time.time(), hostname, phase, log_name, size, compressed_size, seconds)
+        with self._metric_samples_lock:
+            self._metric_samples.append(sample)
+
+    def get_log_grabber_metrics(self, csv_file=None):
+        """
+        Статистика сбора логов.
+
+        Метрики сохраняются по фазам: measure - измерение логов на сервере,
+        stream - получение сжатой новой части лога (вырезание, фильтрация, сжатие и передача),
+        zip - запись части лога в архив, download - получение всех логов сервера.
+        Сводка по серверам и фазам выводится в лог.
+        При использовании в качестве listener файлы метрик записываются автоматически по окончании запуска
+        с именем файла из параметра report.
+
+        *Args:*\n
+        _csv_file_ - имя файла для записи всех замеров; относительный путь отсчитывается от ${OUTPUT_DIR};
+                     сводка записывается рядом, в файл с суффиксом _summary;\n
+
+        *Returns:*\n
+        Словарь с ключом "<hostname> <phase>" и значением - словарем:
+        | count            | количество замеров |
+        | bytes            | суммарный размер новых частей логов |
+        | compressed_bytes | суммарный размер сжатых новых частей логов |
+        | seconds          | суммарное время, секунды |
+        | max              | максимальное время одного замера, секунды |
+
+        *Example:*\n
+        | ${metrics}=  |  Get Log Grabber Metrics  |  log_grabber_report.csv |
+        =>\n
+        | server.com stream | count=12 | bytes=73400320 | compressed_bytes=5242880 | seconds=8.412 | max=2.975 |
+        """
+        with self._metric_samples_lock:
+            samples = list(self._metric_samples)
+        summary = self._summarize_metrics(samples)
+        lines = ["{} {} | count={} | bytes={} | compressed_bytes={} | seconds={:.3f} | max={:.3f}".format(
+                 hostname, phase, item["count"], item["bytes"], item["compressed_bytes"], item["seconds"], item["max"])
+                 for (hostname, phase), item in sorted(summary.items())]
+        logger.info("LogGrabber metrics:\n" + "\n".join(lines))
+
+        if csv_file is not None:
+            files = self._write_metrics(csv_file, samples, summary)
+            logger.info("LogGrabber metrics are written to {}".format(", ".join(files)))
+        return dict(("{} {}".format(hostname, phase), item) for (hostname, phase), item in summary.items())
+
+    def _summarize_metrics(self, samples):
+        """
+        Сводка замеров по серверам и фазам.
+
+        *Returns:*\n
+        Словарь с ключом (hostname, phase) и значением - словарем count, bytes, compressed_bytes, seconds, max.
+        """
+        summary = dict()
+        for _, hostname, phase, _, size, compressed_size, seconds in samples:
+            item = summary.setdefault((hostname, phase), {"count": 0, "bytes": 0, "compressed_bytes": 0, "seconds": 0.0, "max": 0.0})
+            item["count"] += 1
+            item["bytes"] += size or 0
+            item["compressed_bytes"] += compressed_size or 0
+            item["seconds"] += seconds
+            item["max"] = max(item["max"], seconds)
+        return summary
+
+    def _write_metrics(self, csv_file, samples, summary):
+        """
+        Запись всех замеров в csv_file и сводки по серверам и фазам в файл с суффиксом _summary.
+
+        *Returns:*\n
+        Список имен записанных файлов.
+        """
+        if not os.path.isabs(csv_file):
+            csv_file = os.path.join(self.output_dir, csv_file)
+        with open(csv_file, 'wb') as csv_out:
+            writer = csv.writer(csv_out)
+            writer.writerow(["timestamp", "hostname", "phase", "log", "bytes", "compressed_bytes", "seconds"])
+            for sample in samples:
+                writer.writerow(sample)
+        root, ext = os.path.splitext(csv_file)
+        summary_file = root + "_summary" + (ext or ".csv")
+        with open(summary_file, 'wb') as csv_out:
+            writer = csv.writer(csv_out)
+            writer.writerow(["hostname", "phase", "count", "bytes", "compressed_bytes", "seconds", "max"])
+            for (hostname, phase), item in sorted(summary.items()):
+                writer.writerow([hostname, phase, item["count"], item["bytes"], item["compressed_bytes"],
+                                 "{:.3f}".format(item["seconds"]), "{:.3f}".format(item["max"])])
+        return [csv_file, summary_file]
+
+    def close_connections(self):
+        """
+        Закрытие ssh-соединений с удаленными серверами.
+        Предварительно ожидается завершение фоновых скачиваний логов.
+        Закрываются все соединения из пула, в том числе открытые для других suite.
+        """
+        self._download_queue.join()
+        if self._download_thread is not None:
+            # останавливаем фоновый поток, чтобы он не остался ждать очередь при завершении процесса
+            self._download_queue.put(None)
+            self._download_thread.join()
+            self._download_thread = None
+        self._flush_warnings()
+        with _SSH_POOL_LOCK:
+            pooled = _SSH_POOL.values()
+            _SSH_POOL.clear()
+        for ssh_alias, ssh in pooled:
+            ssh.close_all_connections()
+            _SSH_CONNECT_LOCKS.pop(ssh_alias, None)
+        self._clients.clear()
\ No newline at end of file